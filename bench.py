@@ -0,0 +1,269 @@
+# 명령어 지연 시간/처리량 벤치마크
+# 사용법: python bench.py --users 1000 10000 100000 --output bench.json [--baseline 이전결과.json]
+# 규모마다 별도 프로세스에서 임시 database.db를 만들어 가상 유저/보유 종목/거래 내역을 채운 뒤
+# 디스코드 ctx와 시세 제공자를 대체해서 실제 명령어 콜백을 호출하고 p50/p99, 처리량, 최대 메모리를 기록
+# import 시간과 첫 명령어까지 걸린 시간(콜드 스타트)도 함께 기록
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+SYMBOL_COUNT = 500
+HOLDINGS_PER_USER = 5
+TRANSACTIONS_PER_USER = 10
+HISTORY_DAYS = 400
+
+def bench_symbols():
+    return [f"B{i:03d}" for i in range(SYMBOL_COUNT)]
+
+# 가상 데이터 채우기 (stock 모듈을 import해서 스키마가 만들어진 뒤 호출)
+def seed_database(path, users, seed=0):
+    rng = random.Random(seed)
+    symbols = bench_symbols()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.executemany(
+        "INSERT INTO users (id, balance, initial_balance, total_bonus) VALUES (?, ?, 1000, ?)",
+        ((user_id, rng.uniform(0, 1000), rng.choice((0, 0, 100, 200))) for user_id in range(1, users + 1)),
+    )
+    holdings = []
+    for user_id in range(1, users + 1):
+        for symbol in rng.sample(symbols, rng.randint(1, HOLDINGS_PER_USER * 2 - 1)):
+            holdings.append((user_id, symbol, rng.randint(10, 100), rng.uniform(50, 150)))
+    conn.executemany("INSERT INTO stocks (user_id, stock_symbol, shares, average_price) VALUES (?, ?, ?, ?)", holdings)
+    conn.executemany(
+        "INSERT INTO transactions (user_id, stock_symbol, shares, price, type) VALUES (?, ?, ?, ?, ?)",
+        ((rng.randint(1, users), rng.choice(symbols), rng.randint(1, 50), rng.uniform(50, 150), rng.choice(('buy', 'sell')))
+         for _ in range(users * TRANSACTIONS_PER_USER)),
+    )
+    conn.commit()
+    conn.close()
+    return holdings
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+# 한 규모에 대한 벤치마크 실행 (자식 프로세스)
+def run_scale(users, iterations, concurrency, memory_iterations):
+    started = time.perf_counter()
+    import stock
+    import_seconds = time.perf_counter() - started
+    import numpy as np
+    import pandas as pd
+
+    class FakeUser:
+        def __init__(self, user_id):
+            self.id = user_id
+            self.display_name = f"user{user_id}"
+
+    class FakeContext:
+        guild = None
+
+        def __init__(self, user_id):
+            self.author = FakeUser(user_id)
+            self.replies = 0
+
+        async def reply(self, *args, **kwargs):
+            self.replies += 1
+
+        async def send(self, *args, **kwargs):
+            self.replies += 1
+
+    # 결정적인 가상 시세 (네트워크 없음)
+    class BenchProvider(stock.PriceProvider):
+        name = 'bench'
+
+        def __init__(self):
+            self.prices = {symbol: 50 + (i * 37) % 100 for i, symbol in enumerate(bench_symbols())}
+            index = pd.date_range(end=pd.Timestamp.now(tz='UTC').normalize(), periods=HISTORY_DAYS, freq='D')
+            self.frames = {}
+            for i, symbol in enumerate(bench_symbols()):
+                close = self.prices[symbol] * np.exp(np.cumsum(np.random.default_rng(i).normal(0, 0.01, HISTORY_DAYS)))
+                self.frames[symbol] = pd.DataFrame(
+                    {'Open': close, 'High': close * 1.01, 'Low': close * 0.99, 'Close': close, 'Volume': np.full(HISTORY_DAYS, 1000)},
+                    index=index,
+                )
+
+        def quotes(self, symbols):
+            return {symbol: self.prices[symbol] for symbol in symbols if symbol in self.prices}
+
+        def history(self, symbol, period=None, interval='1d', start=None):
+            frame = self.frames[symbol]
+            if start is not None:
+                return frame[frame.index >= pd.Timestamp(start, tz='UTC')]
+            return frame
+
+    async def fetch_user(user_id):
+        return FakeUser(user_id)
+
+    started = time.perf_counter()
+    holdings = seed_database(stock.DB_PATH, users)
+    seed_seconds = time.perf_counter() - started
+
+    stock.set_price_provider(BenchProvider())
+    stock.bot.fetch_user = fetch_user
+    # 장 시간과 무관하게 매매 경로를 측정
+    stock.is_market_open = lambda now=None: True
+
+    rng = random.Random(1)
+    symbols = bench_symbols()
+    cases = {
+        'assets': lambda: stock.bot.get_command('자산').callback(FakeContext(rng.randint(1, users))),
+        'leaderboard': lambda: stock.bot.get_command('리더보드').callback(FakeContext(rng.randint(1, users))),
+        'buy': lambda: stock.bot.get_command('구매').callback(FakeContext(rng.randint(1, users)), rng.choice(symbols), 1),
+        'sell': lambda: (lambda holding: stock.bot.get_command('판매').callback(FakeContext(holding[0]), holding[1], 1))(rng.choice(holdings)),
+        'stock_graph': lambda: stock.StockView(rng.choice(symbols)).update_graph(FakeContext(rng.randint(1, users))),
+    }
+
+    async def measure(make_call, count):
+        latencies = []
+        errors = 0
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one():
+            nonlocal errors
+            async with semaphore:
+                begin = time.perf_counter()
+                try:
+                    await make_call()
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - begin)
+
+        begin = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(count)))
+        return latencies, errors, time.perf_counter() - begin
+
+    async def main():
+        # 첫 명령어까지 걸린 시간: import + 첫 w!자산 호출 (데이터 생성 시간 제외, 라이브러리 지연 로드 포함)
+        begin = time.perf_counter()
+        await cases['assets']()
+        first_command_seconds = import_seconds + time.perf_counter() - begin
+
+        await stock.warm_cpu_pool()
+        # on_ready와 같은 순서로 포트폴리오 캐시를 올린 뒤 측정
+        started = time.perf_counter()
+        await stock.portfolio_cache.load()
+        cache_load_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        await stock.rebuild_leaderboard()
+        results = {
+            'seed_seconds': seed_seconds,
+            'import_seconds': import_seconds,
+            'first_command_seconds': first_command_seconds,
+            'portfolio_cache_load_seconds': cache_load_seconds,
+            'leaderboard_rebuild_seconds': time.perf_counter() - started,
+            'commands': {},
+        }
+        for name, make_call in cases.items():
+            # 첫 호출(캐시 준비)은 따로 기록하고 분위수 측정에서는 제외
+            begin = time.perf_counter()
+            await make_call()
+            cold_ms = (time.perf_counter() - begin) * 1000
+            latencies, errors, wall = await measure(make_call, iterations)
+            # tracemalloc은 느리므로 지연 시간과 별도로 측정
+            tracemalloc.start()
+            await measure(make_call, memory_iterations)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results['commands'][name] = {
+                'iterations': iterations,
+                'errors': errors,
+                'cold_ms': cold_ms,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'mean_ms': sum(latencies) / len(latencies) * 1000,
+                'throughput_per_s': iterations / wall,
+                'peak_memory_bytes': peak,
+            }
+        return results
+
+    try:
+        return asyncio.run(main())
+    finally:
+        stock.shutdown_executors()
+
+# 이전 결과와 비교해서 p50/p99 변화율 출력
+def compare(results, baseline):
+    for scale, scale_results in results['results'].items():
+        previous = baseline.get('results', {}).get(scale)
+        if not previous:
+            continue
+        for name, metrics in scale_results['commands'].items():
+            old = previous['commands'].get(name)
+            if not old:
+                continue
+            changes = ', '.join(
+                f"{key} {(metrics[key] / old[key] - 1) * 100:+.1f}%" for key in ('cold_ms', 'p50_ms', 'p99_ms') if old.get(key)
+            )
+            print(f"  {scale:>7} {name:<12} {changes}")
+
+def main():
+    parser = argparse.ArgumentParser(description="모의투자 봇 명령어 벤치마크")
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--memory-iterations', type=int, default=20)
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--baseline', help="비교할 이전 결과 JSON")
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--child-output', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        with open(args.child_output, 'w') as f:
+            json.dump(run_scale(args.child, args.iterations, args.concurrency, args.memory_iterations), f)
+        return
+
+    results = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'iterations': args.iterations,
+            'concurrency': args.concurrency,
+        },
+        'results': {},
+    }
+    for users in args.users:
+        # DB 경로는 stock 모듈 import 시점에 정해지므로 규모마다 새 프로세스에서 실행
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'result.json')
+            env = dict(os.environ, MOCK_INVEST_DB=os.path.join(directory, 'database.db'))
+            subprocess.run([
+                sys.executable, os.path.abspath(__file__), '--child', str(users), '--child-output', output,
+                '--iterations', str(args.iterations), '--concurrency', str(args.concurrency),
+                '--memory-iterations', str(args.memory_iterations),
+            ], env=env, check=True)
+            with open(output) as f:
+                results['results'][str(users)] = scale_results = json.load(f)
+        print(f"{users}명 (데이터 생성 {scale_results['seed_seconds']:.1f}s, import {scale_results['import_seconds']:.2f}s, "
+              f"첫 명령어까지 {scale_results['first_command_seconds']:.2f}s, 포트폴리오 캐시 {scale_results['portfolio_cache_load_seconds']:.2f}s, 리더보드 재구성 {scale_results['leaderboard_rebuild_seconds'] * 1000:.0f}ms)")
+        for name, metrics in scale_results['commands'].items():
+            print(f"  {name:<12} cold {metrics['cold_ms']:8.2f}ms  p50 {metrics['p50_ms']:8.2f}ms  p99 {metrics['p99_ms']:8.2f}ms  "
+                  f"{metrics['throughput_per_s']:8.1f}/s  peak {metrics['peak_memory_bytes'] / 1024:8.0f}KiB  errors {metrics['errors']}")
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("이전 결과 대비:")
+        compare(results, baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# 차트 렌더링 (프로세스 풀 워커에서 실행)
+# 워커가 봇 모듈(discord, pandas, DB 연결 등)을 불러오지 않도록 numpy와 matplotlib/mplfinance만 사용
+import os
+from io import BytesIO
+
+import numpy as np
+
+# 차트에 그리는 지표 (이름, 패널, 색, 종류), 패널은 price / RSI / MACD
+CHART_OVERLAYS = (
+    ('ma20', 'price', 'tab:orange', 'line'), ('ma60', 'price', 'tab:purple', 'line'),
+    ('bb_upper', 'price', 'tab:gray', 'line'), ('bb_lower', 'price', 'tab:gray', 'line'),
+    ('rsi', 'RSI', 'tab:blue', 'line'),
+    ('macd', 'MACD', 'tab:blue', 'line'), ('macd_signal', 'MACD', 'tab:red', 'line'), ('macd_hist', 'MACD', 'tab:gray', 'bar'),
+)
+
+# 차트 라이브러리 로드 (프로세스 풀 워커에서만 필요하므로 처음 사용할 때 불러옴)
+def chart_modules():
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+    import mplfinance as mpf
+    return plt, mdates, mpf
+
+# 프로세스 풀 워커 초기화: 첫 요청 전에 폰트 캐시와 렌더러를 미리 로드
+def warm_chart_worker():
+    plt, _, _ = chart_modules()
+    fig, ax = plt.subplots()
+    ax.plot([0, 1], [0, 1])
+    fig.savefig(BytesIO(), format='png')
+    plt.close(fig)
+
+def chart_worker_pid():
+    return os.getpid()
+
+# 캔들 차트와 지표를 PNG 바이트로 렌더링
+# 가격 패널에 이동평균/볼린저 밴드, 아래에 거래량/RSI/MACD 패널 (값이 하나도 없는 지표 패널은 생략)
+def render_candle_chart(symbol, timeframe, bars, indicators):
+    plt, _, mpf = chart_modules()
+    overlays = [overlay for overlay in CHART_OVERLAYS if np.isfinite(indicators[overlay[0]]).any()]
+    # 0: 가격, 1: 거래량, 그 뒤로 실제로 그릴 지표 패널만 차례대로 번호를 붙임
+    panels = {'price': 0}
+    for _, panel, _, _ in overlays:
+        if panel not in panels:
+            panels[panel] = len(panels) + 1
+    addplots = []
+    for name, panel, color, kind in overlays:
+        if kind == 'bar':
+            addplots.append(mpf.make_addplot(indicators[name], panel=panels[panel], type='bar', color=color, alpha=0.5))
+        else:
+            addplots.append(mpf.make_addplot(indicators[name], panel=panels[panel], color=color, width=0.8,
+                                             linestyle='--' if name.startswith('bb_') else '-', ylabel='' if panel == 'price' else panel))
+    panel_ratios = (4, 1) + (1,) * (len(panels) - 1)
+    fig, _ = mpf.plot(bars, type='candle', style='charles', volume=True, addplot=addplots, panel_ratios=panel_ratios,
+                      figsize=(10, 8), title=f"{symbol} {timeframe}", ylabel='Price (USD)', returnfig=True)
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png')
+    plt.close(fig)
+    return buf.getvalue()
+
+# 자산 추이 그래프를 PNG 바이트로 렌더링
+def render_equity_chart(title, dates, equity, principal):
+    plt, mdates, _ = chart_modules()
+    fig, ax = plt.subplots()
+    ax.plot(dates, equity, label='Total assets')
+    ax.plot(dates, principal, label='Invested + bonus', linestyle='--')
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d'))
+    fig.autofmt_xdate()
+    ax.set_title(title)
+    ax.set_xlabel('Date')
+    ax.set_ylabel('USD')
+    ax.legend()
+
+    buf = BytesIO()
+    fig.savefig(buf, format='png')
+    plt.close(fig)
+    return buf.getvalue()
@@ -1,20 +1,37 @@
+import time as _time
+# 프로세스 시작 시각 (첫 명령어 처리까지 걸린 시간 측정용)
+STARTED_AT = _time.perf_counter()
+
 import discord
 from discord.ext import commands, tasks
 from discord.ui import Button, View
-import yfinance as yf
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import sqlite3
-from io import BytesIO
-from currency_converter import CurrencyConverter
-from forex_python.converter import CurrencyRates
+from io import BytesIO, TextIOWrapper
+import csv
+import gzip
+import tempfile
 import math
+from bisect import bisect_left, insort
+import heapq
+from collections import OrderedDict, deque
+from array import array
+from itertools import groupby
+from operator import itemgetter
 from datetime import datetime, time, timedelta, date
 import pytz
 import asyncio
-from pandas.tseries.holiday import USFederalHolidayCalendar
+import os
+import threading
+import sys
+import types
+import multiprocessing
 import numpy as np
-import mplfinance as mpf
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial, wraps
+from contextlib import contextmanager
+
+import charts
 
 
 # 디스코드 봇 설정
@@ -23,105 +40,975 @@ intents.message_content = True
 intents.members = True
 bot = commands.Bot(command_prefix='w!', intents=intents)
 
-# 데이터베이스 연결
-conn = sqlite3.connect('database.db')
-c = conn.cursor()
-
-# users 테이블이 없으면 생성
-c.execute('''
-CREATE TABLE IF NOT EXISTS users (
-    id INTEGER PRIMARY KEY,
-    balance REAL,
-    initial_balance REAL,
-    total_bonus REAL DEFAULT 0,
-    last_bonus_time TEXT
-)
-''')
-conn.commit()
-
-# stocks 테이블이 없으면 생성
-c.execute('''
-CREATE TABLE IF NOT EXISTS stocks (
-    user_id INTEGER,
-    stock_symbol TEXT,
-    shares INTEGER,
-    average_price REAL DEFAULT 0,
-    PRIMARY KEY (user_id, stock_symbol),
-    FOREIGN KEY(user_id) REFERENCES users(id)
-)
-''')
-conn.commit()
-
-# stock_data 테이블이 없으면 생성
-c.execute('''
-CREATE TABLE IF NOT EXISTS stock_data (
-    symbol TEXT,
-    date TEXT,
-    close REAL,
-    PRIMARY KEY (symbol, date)
-)
-''')
-conn.commit()
-
-# limit_orders 테이블이 없으면 생성
-c.execute('''
-CREATE TABLE IF NOT EXISTS limit_orders (
-    order_id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    symbol TEXT,
-    shares INTEGER,
-    price REAL,
-    order_type TEXT,
-    timestamp TEXT,
-    FOREIGN KEY(user_id) REFERENCES users(id)
-)
-''')
-conn.commit()
-
-# transactions 테이블을 생성
-c.execute('''
-CREATE TABLE IF NOT EXISTS transactions (
-    id INTEGER PRIMARY KEY AUTOINCREMENT,
-    user_id INTEGER,
-    stock_symbol TEXT,
-    shares INTEGER,
-    price REAL,
-    type TEXT, -- 'buy' or 'sell'
-    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-    FOREIGN KEY(user_id) REFERENCES users(id)
-)
-''')
-
-conn.commit()
-
-# 거래 내역을 저장하기
-def record_transaction(user_id, stock_symbol, shares, price, transaction_type):
-    c = conn.cursor()
-    
-    c.execute('''
+# 블로킹 작업 실행기 설정 (환경 변수로 풀 크기 조정)
+IO_POOL_SIZE = int(os.environ.get('MOCK_INVEST_IO_WORKERS', 8))
+CPU_POOL_SIZE = int(os.environ.get('MOCK_INVEST_CPU_WORKERS', 2))
+
+# 네트워크/파일 작업용 스레드 풀
+io_executor = ThreadPoolExecutor(max_workers=IO_POOL_SIZE, thread_name_prefix='mock-invest-io')
+# 차트 렌더링 같은 CPU 작업용 프로세스 풀 (처음 사용할 때 생성, 워커는 matplotlib을 미리 준비)
+# 스레드가 도는 프로세스를 fork하면 자식에 잠긴 락이 남을 수 있으므로 forkserver로 워커를 만듦
+# 워커는 charts 모듈만 불러오고 이 스크립트(봇, DB 연결, 스키마 마이그레이션)는 다시 실행하지 않음
+cpu_executor = None
+
+class ChartPoolExecutor(ProcessPoolExecutor):
+    # multiprocessing은 새 워커마다 __main__ 스크립트를 다시 실행하므로, 워커를 띄우는 동안만 빈 모듈로 가림
+    # (풀에 넘기는 함수는 모두 charts 모듈에 있으므로 워커에 __main__이 필요 없음)
+    _spawn_lock = threading.Lock()
+
+    def _spawn_process(self):
+        with self._spawn_lock:
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = types.ModuleType('__main__')
+            try:
+                super()._spawn_process()
+            finally:
+                sys.modules['__main__'] = main
+
+def get_cpu_executor():
+    global cpu_executor
+    if cpu_executor is None:
+        context = multiprocessing.get_context('forkserver')
+        # forkserver 프로세스도 기본값(__main__) 대신 charts만 미리 불러옴
+        context.set_forkserver_preload(['charts'])
+        cpu_executor = ChartPoolExecutor(max_workers=CPU_POOL_SIZE, mp_context=context, initializer=charts.warm_chart_worker)
+    return cpu_executor
+
+# 블로킹 함수를 I/O 스레드 풀에서 실행
+async def run_io(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(io_executor, partial(func, *args, **kwargs))
+
+# CPU 작업을 프로세스 풀에서 실행 (함수와 인자는 pickle 가능해야 함)
+async def run_cpu(func, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(get_cpu_executor(), partial(func, *args, **kwargs))
+
+def shutdown_executors():
+    io_executor.shutdown(wait=False, cancel_futures=True)
+    storage.close()
+    if cpu_executor is not None:
+        cpu_executor.shutdown(wait=False, cancel_futures=True)
+
+# 지연 시간 히스토그램 버킷 상한(초), 마지막은 +Inf
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+# Prometheus 텍스트 파일 경로와 기록 주기(초)
+METRICS_PATH = os.environ.get('MOCK_INVEST_METRICS_FILE', 'metrics.prom')
+METRICS_EXPORT_SECONDS = 60
+
+# 고정 버킷 히스토그램 (버킷별 개수만 저장하므로 관측당 비용이 일정)
+class Histogram:
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(METRIC_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(METRIC_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.counts = list(self.counts)
+        histogram.total = self.total
+        histogram.count = self.count
+        return histogram
+
+    def quantile(self, q):
+        # 해당 분위수가 속한 버킷의 상한을 반환
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for bound, count in zip(METRIC_BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return METRIC_BUCKETS[-1]
+
+# 지표 저장소: (지표 이름, 라벨) -> Histogram
+# 스레드 풀에서도 기록하므로 잠금으로 보호
+class Metrics:
+    def __init__(self):
+        self.histograms = {}
+        self.errors = {}  # (지표 이름, 라벨) -> 실패 횟수
+        self._lock = threading.Lock()
+
+    def observe(self, name, label, seconds):
+        with self._lock:
+            histogram = self.histograms.get((name, label))
+            if histogram is None:
+                histogram = self.histograms[(name, label)] = Histogram()
+            histogram.observe(seconds)
+
+    def error(self, name, label):
+        with self._lock:
+            self.errors[(name, label)] = self.errors.get((name, label), 0) + 1
+
+    @contextmanager
+    def time(self, name, label):
+        started = _time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.error(name, label)
+            raise
+        finally:
+            self.observe(name, label, _time.perf_counter() - started)
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {key: histogram.copy() for key, histogram in self.histograms.items()}
+            return histograms, dict(self.errors)
+
+metrics = Metrics()
+
+# 함수 실행 시간을 기록하는 데코레이터 (동기/코루틴 함수 모두 사용 가능)
+def timed(name, label=None):
+    def decorator(func):
+        metric_label = label or func.__name__
+        if asyncio.iscoroutinefunction(func):
+            @wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with metrics.time(name, metric_label):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.time(name, metric_label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# 데이터베이스 설정
+DB_PATH = os.environ.get('MOCK_INVEST_DB', 'database.db')
+DB_READ_POOL_SIZE = int(os.environ.get('MOCK_INVEST_DB_READERS', 4))
+# 한 번의 그룹 커밋에 묶을 최대 쓰기 작업 수
+DB_GROUP_COMMIT_MAX = 256
+
+# SQLite 저장소: 쓰기는 하나의 writer 태스크가 모아서 그룹 커밋하고, 읽기는 읽기 전용 연결 풀에서 처리
+class Storage:
+    def __init__(self, path, readers=DB_READ_POOL_SIZE):
+        self.path = path
+        # isolation_level=None: 트랜잭션은 writer가 직접 BEGIN/COMMIT으로 관리
+        self.writer_conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.writer_conn.execute("PRAGMA journal_mode=WAL")
+        self.writer_conn.execute("PRAGMA synchronous=NORMAL")
+        self.writer_conn.execute("PRAGMA busy_timeout=5000")
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mock-invest-db-writer')
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='mock-invest-db-reader')
+        self._local = threading.local()
+        self._queue = None
+        self._writer_task = None
+        self._commit_callbacks = []  # 현재 배치가 커밋된 뒤 실행할 (func, args) (writer 스레드에서만 접근)
+
+    def _reader(self):
+        reader = getattr(self._local, 'conn', None)
+        if reader is None:
+            reader = self._local.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            reader.execute("PRAGMA busy_timeout=5000")
+        return reader
+
+    def _read(self, func, args):
+        cur = self._reader().cursor()
+        try:
+            return func(cur, *args)
+        finally:
+            cur.close()
+
+    def _commit_batch(self, batch):
+        # 작업마다 SAVEPOINT를 걸어 하나가 실패해도 나머지는 같은 커밋에 포함
+        started = _time.perf_counter()
+        cur = self.writer_conn.cursor()
+        results = []
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for func, args, _ in batch:
+                cur.execute("SAVEPOINT job")
+                callbacks_mark = len(self._commit_callbacks)
+                try:
+                    results.append((True, func(cur, *args)))
+                    cur.execute("RELEASE job")
+                except Exception as e:
+                    cur.execute("ROLLBACK TO job")
+                    cur.execute("RELEASE job")
+                    del self._commit_callbacks[callbacks_mark:]
+                    results.append((False, e))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            self._commit_callbacks = []
+            metrics.error('db', 'commit')
+            raise
+        metrics.observe('db', 'commit', _time.perf_counter() - started)
+        callbacks, self._commit_callbacks = self._commit_callbacks, []
+        return results, callbacks
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < DB_GROUP_COMMIT_MAX and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            callbacks = []
+            try:
+                results, callbacks = await loop.run_in_executor(self._write_executor, self._commit_batch, batch)
+            except Exception as e:
+                results = [(False, e)] * len(batch)
+            # 커밋된 변경을 메모리 캐시에 반영 (이벤트 루프에서 커밋 순서대로, 기다리는 쪽이 깨어나기 전에 실행)
+            for func, args in callbacks:
+                try:
+                    func(*args)
+                except Exception as e:
+                    print(f"커밋 후 처리 중 오류: {e}")
+            for (_, _, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def start(self):
+        if self._writer_task is None or self._writer_task.done():
+            self._queue = asyncio.Queue()
+            self._writer_task = asyncio.get_running_loop().create_task(self._writer())
+
+    async def write(self, func, *args):
+        # func(cursor, *args)를 하나의 원자적 단위로 실행하고, 커밋된 뒤 결과를 반환
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((func, args, future))
+        with metrics.time('db', 'write'):
+            return await future
+
+    def on_commit(self, func, *args):
+        # 쓰기 작업(func(cur, ...)) 안에서 호출: 이 작업이 커밋되면 이벤트 루프에서 func(*args) 실행, 롤백되면 버림
+        self._commit_callbacks.append((func, args))
+
+    async def read(self, func, *args):
+        # func(cursor, *args)를 읽기 전용 연결에서 실행
+        with metrics.time('db', 'read'):
+            return await asyncio.get_running_loop().run_in_executor(self._read_executor, self._read, func, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda cur: cur.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda cur: cur.execute(sql, params).fetchall())
+
+    async def execute(self, *statements):
+        # (sql, params) 문장들을 하나의 원자적 단위로 실행
+        def run(cur):
+            for sql, params in statements:
+                cur.execute(sql, params)
+        await self.write(run)
+
+    def close(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+        self._read_executor.shutdown(wait=False, cancel_futures=True)
+        self._write_executor.shutdown(wait=True)
+        self.writer_conn.close()
+
+storage = Storage(DB_PATH)
+
+# 스키마 버전 1: 기본 테이블과 인덱스 (버전 관리 이전에 만들어진 DB도 이 단계에서 맞춤)
+def migrate_v1(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        balance REAL,
+        initial_balance REAL,
+        total_bonus REAL DEFAULT 0,
+        last_bonus_time TEXT
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS stocks (
+        user_id INTEGER,
+        stock_symbol TEXT,
+        shares INTEGER,
+        average_price REAL DEFAULT 0,
+        PRIMARY KEY (user_id, stock_symbol),
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS stock_data (
+        symbol TEXT,
+        date TEXT,
+        close REAL,
+        open REAL,
+        high REAL,
+        low REAL,
+        volume INTEGER,
+        PRIMARY KEY (symbol, date)
+    )
+    ''')
+    # 예전 stock_data 테이블에 OHLCV 컬럼 추가
+    stock_data_columns = {row[1] for row in cur.execute("PRAGMA table_info(stock_data)")}
+    for column, column_type in (('open', 'REAL'), ('high', 'REAL'), ('low', 'REAL'), ('volume', 'INTEGER')):
+        if column not in stock_data_columns:
+            cur.execute(f"ALTER TABLE stock_data ADD COLUMN {column} {column_type}")
+    # 보유 종목 목록 조회용 인덱스
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_stocks_symbol ON stocks(stock_symbol)")
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS limit_orders (
+        order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        symbol TEXT,
+        shares INTEGER,
+        price REAL,
+        order_type TEXT,
+        timestamp TEXT,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS transactions (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        stock_symbol TEXT,
+        shares INTEGER,
+        price REAL,
+        type TEXT, -- 'buy' or 'sell'
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(user_id) REFERENCES users(id)
+    )
+    ''')
+
+# 스키마 버전 2: 유저별 거래 내역 조회용 인덱스 (rowid가 포함되므로 (timestamp, id) 키셋 조회에 사용)
+def migrate_v2(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_transactions_user_time ON transactions(user_id, timestamp)")
+
+# 스키마 버전 3: 장 마감마다 기록하는 유저별 자산 스냅샷
+# equity_positions는 마지막 스냅샷 시점의 보유 수량/매수 원가, equity_progress는 마지막 스냅샷 날짜와 반영한 거래 id
+def migrate_v3(cur):
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS equity_snapshots (
+        user_id INTEGER,
+        date TEXT,
+        cash REAL, -- 잔고 + 예약 매수로 묶인 금액
+        holdings_value REAL,
+        net_invested REAL, -- 초기 잔액 + 보유 주식 매수 원가
+        total_bonus REAL,
+        PRIMARY KEY (user_id, date)
+    ) WITHOUT ROWID
+    ''')
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_equity_snapshots_date ON equity_snapshots(date)")
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS equity_positions (
+        user_id INTEGER,
+        stock_symbol TEXT,
+        shares INTEGER,
+        cost REAL,
+        PRIMARY KEY (user_id, stock_symbol)
+    ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS equity_progress (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        date TEXT,
+        transaction_id INTEGER
+    )
+    ''')
+
+# 스키마 마이그레이션 목록 (순서대로 PRAGMA user_version 1, 2, ...에 해당, 새 변경은 끝에 추가)
+MIGRATIONS = [migrate_v1, migrate_v2, migrate_v3]
+
+# 아직 적용하지 않은 마이그레이션을 한 트랜잭션으로 적용 (최신 버전이면 PRAGMA 조회 한 번으로 끝남)
+def migrate_schema(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= len(MIGRATIONS):
+        return version
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        # 다른 프로세스가 먼저 마이그레이션했을 수 있으므로 잠금을 잡은 뒤 다시 확인
+        version = cur.execute("PRAGMA user_version").fetchone()[0]
+        for migration in MIGRATIONS[version:]:
+            migration(cur)
+        cur.execute(f"PRAGMA user_version = {len(MIGRATIONS)}")
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    return len(MIGRATIONS)
+
+migrate_schema(storage.writer_conn)
+
+# 거래 내역을 저장하기 (쓰기 트랜잭션 안에서 호출)
+def record_transaction(cur, user_id, stock_symbol, shares, price, transaction_type):
+    cur.execute('''
     INSERT INTO transactions (user_id, stock_symbol, shares, price, type)
     VALUES (?, ?, ?, ?, ?)
     ''', (user_id, stock_symbol, shares, price, transaction_type))
-    
-    conn.commit()
+
+# 한 행 조회
+async def db_fetchone(sql, params=()):
+    return await storage.fetchone(sql, params)
+
+# 여러 행 조회
+async def db_fetchall(sql, params=()):
+    return await storage.fetchall(sql, params)
+
+# (sql, params) 문장들을 한 번에 실행하고 커밋
+async def db_write(*statements):
+    await storage.execute(*statements)
+
+# 같은 키에 대한 동시 요청을 하나의 작업으로 합침
+# 먼저 들어온 요청이 작업을 실행하고, 나머지는 그 결과를 함께 기다림
+class SingleFlight:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0  # 실제로 실행된 작업 수
+        self.coalesced = 0  # 진행 중인 작업에 합쳐진 요청 수
+        self._inflight = {}  # key -> asyncio.Future
+
+    def _run(self, keys, coro, pick):
+        # 공유 작업을 별도 태스크로 실행하고, 키마다 결과를 받을 Future를 등록
+        # 요청한 쪽이 취소돼도 작업은 계속되므로 같은 작업을 기다리는 다른 요청은 영향을 받지 않음
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in keys}
+        self._inflight.update(futures)
+        self.calls += 1
+        task = asyncio.ensure_future(coro)
+
+        def finish(task):
+            for key, future in futures.items():
+                del self._inflight[key]
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                    future.exception()  # 기다리는 쪽이 없어도 경고가 나지 않도록 처리
+                else:
+                    future.set_result(pick(task.result(), key))
+        task.add_done_callback(finish)
+        return futures
+
+    async def do(self, key, func):
+        # func: 인자 없는 코루틴 함수
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = self._run([key], func(), lambda result, _: result)[key]
+        return await asyncio.shield(future)
+
+    async def do_many(self, keys, func):
+        # func(keys)는 {key: 결과} dict를 돌려주는 코루틴 함수, 결과가 없는 키는 빠짐
+        # 이미 진행 중인 키는 기다리고, 나머지만 한 번의 호출로 처리
+        waiting = {}
+        new_keys = []
+        for key in keys:
+            future = self._inflight.get(key)
+            if future is not None:
+                waiting[key] = future
+            else:
+                new_keys.append(key)
+        self.coalesced += len(waiting)
+        if new_keys:
+            waiting.update(self._run(new_keys, func(new_keys), lambda results, key: results.get(key)))
+
+        results = {}
+        for key, future in waiting.items():
+            results[key] = await asyncio.shield(future)
+        return {key: value for key, value in results.items() if value is not None}
+
+# 시세 조회와 히스토리 동기화용 single-flight
+price_flight = SingleFlight('price')
+history_flight = SingleFlight('history')
+
+# 시세 캐시 유지 시간(초)
+QUOTE_TTL_SECONDS = 30
+
+# 시세 제공자 인터페이스: 현재가 묶음 조회와 OHLCV 히스토리 조회
+class PriceProvider:
+    name = 'base'
+
+    def quotes(self, symbols):
+        # {심볼: 현재가}, 조회되지 않은 심볼은 빠짐
+        raise NotImplementedError
+
+    def history(self, symbol, period=None, interval='1d', start=None):
+        # Open/High/Low/Close/Volume 컬럼과 DatetimeIndex를 가진 DataFrame
+        raise NotImplementedError
+
+# yfinance 시세 제공자
+class YFinanceProvider(PriceProvider):
+    name = 'yfinance'
+
+    def quotes(self, symbols):
+        import yfinance as yf
+        symbols = sorted(symbols)
+        if not symbols:
+            return {}
+        data = yf.download(symbols, period='5d', group_by='ticker', auto_adjust=True, progress=False, threads=True)
+        quotes = {}
+        if data.empty:
+            return quotes
+        for symbol in symbols:
+            try:
+                closes = data[symbol]['Close'] if symbol in data.columns.get_level_values(0) else data['Close']
+            except KeyError:
+                continue
+            closes = closes.dropna()
+            if not closes.empty:
+                quotes[symbol] = float(closes.iloc[-1])
+        return quotes
+
+    def history(self, symbol, period=None, interval='1d', start=None):
+        import yfinance as yf
+        if start is not None:
+            return yf.Ticker(symbol).history(start=start, interval=interval)
+        return yf.Ticker(symbol).history(period=period, interval=interval)
+
+# yfinance 기간 문자열('5d', '3mo', '5y', 'max')을 timedelta로 변환, 'max'는 None
+def parse_period(period):
+    if not period or period == 'max':
+        return None
+    for suffix, days in (('mo', 30), ('wk', 7), ('d', 1), ('y', 365)):
+        if period.endswith(suffix):
+            return timedelta(days=int(period[:-len(suffix)]) * days)
+    raise ValueError(f"알 수 없는 기간입니다: {period}")
+
+REPLAY_FIELDS = ('timestamp', 'open', 'high', 'low', 'close', 'volume')
+
+# 녹화된 시세 재생 제공자 (오프라인 부하 테스트/벤치마크용)
+# directory/심볼/{timestamp,open,high,low,close,volume}.npy 파일을 메모리 매핑해서 읽음
+# timestamp는 UTC epoch 초, 재생 시계는 시작 시각부터 speed 배속으로 흐름
+class ReplayProvider(PriceProvider):
+    name = 'replay'
+
+    def __init__(self, directory, speed=1.0, start=None):
+        self.directory = directory
+        self.speed = speed
+        self._columns = {}  # symbol -> {field: np.memmap}, 파일이 없으면 None
+        self._lock = threading.Lock()
+        if start is None:
+            firsts = [columns['timestamp'][0] for columns in map(self._load, self.symbols()) if columns is not None and len(columns['timestamp'])]
+            start = float(min(firsts)) if firsts else _time.time()
+        self.replay_start = start
+        self.wall_start = _time.monotonic()
+
+    def symbols(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if os.path.isfile(os.path.join(self.directory, name, 'timestamp.npy')))
+
+    def _load(self, symbol):
+        if symbol not in self._columns:
+            with self._lock:
+                if symbol not in self._columns:
+                    path = os.path.join(self.directory, symbol)
+                    try:
+                        self._columns[symbol] = {field: np.load(os.path.join(path, f"{field}.npy"), mmap_mode='r') for field in REPLAY_FIELDS}
+                    except FileNotFoundError:
+                        self._columns[symbol] = None
+        return self._columns[symbol]
+
+    def now(self):
+        # 현재 재생 시각 (UTC epoch 초)
+        return self.replay_start + (_time.monotonic() - self.wall_start) * self.speed
+
+    def quotes(self, symbols):
+        now = self.now()
+        quotes = {}
+        for symbol in symbols:
+            columns = self._load(symbol)
+            if columns is None:
+                continue
+            i = int(np.searchsorted(columns['timestamp'], now, side='right')) - 1
+            if i >= 0:
+                quotes[symbol] = float(columns['close'][i])
+        return quotes
+
+    def history(self, symbol, period=None, interval='1d', start=None):
+        # 녹화된 봉 간격 그대로 반환 (interval은 무시)
+        columns = self._load(symbol)
+        if columns is None:
+            return pd.DataFrame(columns=HISTORY_COLUMNS, index=pd.DatetimeIndex([], tz='UTC'))
+        now = self.now()
+        if start is not None:
+            begin = pd.Timestamp(start, tz='UTC').timestamp()
+        else:
+            length = parse_period(period)
+            begin = now - length.total_seconds() if length else -np.inf
+        timestamps = columns['timestamp']
+        lo = int(np.searchsorted(timestamps, begin, side='left'))
+        hi = int(np.searchsorted(timestamps, now, side='right'))
+        return pd.DataFrame(
+            {column: np.asarray(columns[column.lower()][lo:hi]) for column in HISTORY_COLUMNS},
+            index=pd.to_datetime(np.asarray(timestamps[lo:hi]), unit='s', utc=True),
+        )
+
+# OHLCV DataFrame을 재생 파일로 저장 (녹화용)
+def save_replay_history(directory, symbol, frame):
+    path = os.path.join(directory, symbol)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'timestamp.npy'), frame.index.as_unit('s').asi8.astype(np.float64))
+    for column in HISTORY_COLUMNS:
+        dtype = np.int64 if column == 'Volume' else np.float64
+        np.save(os.path.join(path, f"{column.lower()}.npy"), frame[column].to_numpy(dtype=dtype))
+
+# 환경 변수로 시세 제공자 선택 (MOCK_INVEST_PRICE_PROVIDER=yfinance 또는 replay:<디렉터리>)
+def create_price_provider():
+    spec = os.environ.get('MOCK_INVEST_PRICE_PROVIDER', 'yfinance')
+    if spec.startswith('replay:'):
+        return ReplayProvider(spec[len('replay:'):], speed=float(os.environ.get('MOCK_INVEST_REPLAY_SPEED', 1.0)))
+    return YFinanceProvider()
+
+price_provider = create_price_provider()
+
+# 시세 제공자 교체 (캐시된 시세는 비움)
+def set_price_provider(provider):
+    global price_provider
+    price_provider = provider
+    quote_cache.clear()
+
+# 여러 심볼의 현재가를 한 번의 요청으로 조회
+@timed('price', 'quotes')
+def fetch_quotes(symbols):
+    return price_provider.quotes(symbols)
+
+# 프로세스 전역 시세 캐시
+class QuoteCache:
+    def __init__(self, ttl=QUOTE_TTL_SECONDS):
+        self.ttl = ttl
+        self._quotes = {}  # symbol -> (price, fetched_at)
+        self._lock = threading.Lock()
+
+    def lookup(self, symbols):
+        # TTL 안에 있는 시세와 새로 받아야 할 심볼을 나눠서 반환
+        now = _time.monotonic()
+        found, missing = {}, set()
+        with self._lock:
+            for symbol in symbols:
+                entry = self._quotes.get(symbol)
+                if entry and now - entry[1] < self.ttl:
+                    found[symbol] = entry[0]
+                else:
+                    missing.add(symbol)
+        return found, missing
+
+    def update(self, quotes):
+        now = _time.monotonic()
+        with self._lock:
+            for symbol, price in quotes.items():
+                self._quotes[symbol] = (price, now)
+
+    def refresh(self, symbols):
+        # TTL과 관계없이 새로 받아서 캐시에 저장
+        fetched = fetch_quotes(symbols)
+        self.update(fetched)
+        return fetched
+
+    def get_many(self, symbols):
+        symbols = {symbol.upper() for symbol in symbols}
+        found, missing = self.lookup(symbols)
+        if missing:
+            found.update(self.refresh(missing))
+        return found
+
+    def clear(self):
+        with self._lock:
+            self._quotes.clear()
+
+quote_cache = QuoteCache()
+
+# 여러 주식 가격 조회 (조회되지 않은 심볼은 결과에서 빠짐)
+def get_stock_prices(symbols):
+    return quote_cache.get_many(symbols)
 
 # 주식 가격 조회
 def get_stock_price(symbol):
-    stock = yf.Ticker(symbol)
-    todays_data = stock.history(period='1d')
-    if not todays_data.empty:
-        return todays_data['Close'].iloc[0]
-    else:
+    price = get_stock_prices([symbol]).get(symbol.upper())
+    if price is None:
+        raise ValueError("주식 가격 데이터를 가져올 수 없습니다.")
+    return price
+
+# 시세 폴링 설정: 장중 폴링 주기(초), 장이 닫혀 있을 때 최대 대기 시간(초), 한 번에 받을 심볼 수
+PRICE_POLL_SECONDS = 15
+PRICE_POLL_IDLE_SECONDS = 3600
+PRICE_POLL_BATCH_SIZE = 200
+
+# 보유 중이거나 예약 주문이 걸린 모든 심볼
+def load_tracked_symbols(cur):
+    cur.execute("SELECT DISTINCT stock_symbol FROM stocks UNION SELECT DISTINCT symbol FROM limit_orders")
+    return {row[0] for row in cur.fetchall()}
+
+# 장중에는 추적 중인 모든 심볼의 시세를 미리 받아 캐시를 따뜻하게 유지하고,
+# 장이 닫혀 있으면 다음 개장까지 쉼
+async def poll_tracked_prices():
+    now = datetime.now(tz=pytz.UTC)
+    if not is_market_open(now):
+        next_open = next_market_open(now)
+        wait = (next_open - now).total_seconds() if next_open else PRICE_POLL_IDLE_SECONDS
+        poll_prices.change_interval(seconds=min(max(wait, 1), PRICE_POLL_IDLE_SECONDS))
+        return
+    poll_prices.change_interval(seconds=PRICE_POLL_SECONDS)
+
+    symbols = sorted(await storage.read(load_tracked_symbols) | matching_engine.symbols())
+    for i in range(0, len(symbols), PRICE_POLL_BATCH_SIZE):
+        batch = symbols[i:i + PRICE_POLL_BATCH_SIZE]
+        # 명령어가 같은 심볼을 받는 중이면 그 결과를 함께 사용
+        await price_flight.do_many(batch, lambda keys: run_io(quote_cache.refresh, keys))
+
+# 태스크 루프는 예외가 나면 멈추므로 오류를 출력하고 다음 주기에 다시 시도
+@tasks.loop(seconds=PRICE_POLL_SECONDS)
+async def poll_prices():
+    try:
+        await poll_tracked_prices()
+    except Exception as e:
+        print(f"시세 폴링 중 오류: {e}")
+
+# 여러 주식 가격 조회 (이벤트 루프용): 캐시에 없는 심볼만 받고, 같은 심볼을 받는 중이면 그 결과를 기다림
+async def fetch_stock_prices(symbols):
+    found, missing = quote_cache.lookup({symbol.upper() for symbol in symbols})
+    if missing:
+        found.update(await price_flight.do_many(sorted(missing), lambda keys: run_io(get_stock_prices, keys)))
+    return found
+
+# 주식 가격 조회 (이벤트 루프용)
+async def fetch_stock_price(symbol):
+    price = (await fetch_stock_prices([symbol])).get(symbol.upper())
+    if price is None:
         raise ValueError("주식 가격 데이터를 가져올 수 없습니다.")
+    return price
     
+# 처음 받을 때 가져올 일봉 기간
+HISTORY_BACKFILL_PERIOD = '5y'
+# 장중에 같은 심볼을 다시 동기화하기까지의 최소 간격(초)
+HISTORY_SYNC_SECONDS = 300
+HISTORY_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+# 주가 히스토리 조회
+@timed('price', 'history')
+def fetch_history(symbol, period=None, interval='1d', start=None):
+    return price_provider.history(symbol, period=period, interval=interval, start=start)
+
+# 동기화 시각(UTC timestamp)이 최신인지: 장중에는 HISTORY_SYNC_SECONDS 이내, 장 마감 후에는 마감 이후에 동기화했으면 최신
+def is_synced(synced_at):
+    if synced_at is None:
+        return False
+    now = datetime.now(tz=pytz.UTC)
+    if is_market_open(now):
+        return now.timestamp() - synced_at < HISTORY_SYNC_SECONDS
+    last_close = previous_market_close(now)
+    return last_close is None or synced_at >= last_close.timestamp()
+
+# stock_data 테이블을 일봉 OHLCV 저장소로 사용
+# 심볼마다 한 번 전체를 받고, 이후에는 마지막 저장일 이후의 봉만 받아 덧붙임
+class HistoryStore:
+    def __init__(self):
+        self._synced_at = {}  # symbol -> 마지막 동기화 시각 (UTC timestamp)
+
+    def _last_date(self, cur, symbol):
+        cur.execute("SELECT MAX(date) FROM stock_data WHERE symbol=?", (symbol,))
+        return cur.fetchone()[0]
+
+    def _store(self, cur, rows):
+        cur.executemany('''
+        INSERT INTO stock_data (symbol, date, open, high, low, close, volume)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(symbol, date)
+        DO UPDATE SET open = excluded.open, high = excluded.high, low = excluded.low, close = excluded.close, volume = excluded.volume
+        ''', rows)
+
+    def _query(self, cur, symbol, start, end):
+        cur.execute('''
+        SELECT date, open, high, low, close, volume FROM stock_data
+        WHERE symbol=? AND date>=? AND date<=? AND open IS NOT NULL
+        ORDER BY date
+        ''', (symbol, start or '0000-00-00', end or '9999-99-99'))
+        return cur.fetchall()
+
+    def is_fresh(self, symbol):
+        return is_synced(self._synced_at.get(symbol))
+
+    async def sync(self, symbol):
+        # 같은 심볼을 동시에 동기화하면 한 번만 받음
+        symbol = symbol.upper()
+        if self.is_fresh(symbol):
+            return
+        await history_flight.do(symbol, lambda: self._sync(symbol))
+
+    async def _sync(self, symbol):
+        last_date = await storage.read(self._last_date, symbol)
+        if last_date is None:
+            hist = await run_io(fetch_history, symbol, period=HISTORY_BACKFILL_PERIOD)
+        else:
+            # 마지막 봉은 장중에 저장됐을 수 있으므로 다시 받아서 덮어씀
+            hist = await run_io(fetch_history, symbol, start=last_date)
+        if not hist.empty:
+            rows = [
+                (symbol, index.strftime('%Y-%m-%d'), float(row.Open), float(row.High), float(row.Low), float(row.Close), int(row.Volume))
+                for index, row in zip(hist.index, hist[HISTORY_COLUMNS].itertuples(index=False))
+            ]
+            await storage.write(self._store, rows)
+        self._synced_at[symbol] = datetime.now(tz=pytz.UTC).timestamp()
+
+    async def frame(self, symbol, start=None, end=None):
+        # 날짜 범위의 일봉을 DatetimeIndex DataFrame으로 반환 (start/end는 'YYYY-MM-DD')
+        rows = await storage.read(self._query, symbol.upper(), start, end)
+        frame = pd.DataFrame(rows, columns=['Date'] + HISTORY_COLUMNS)
+        frame.index = pd.DatetimeIndex(pd.to_datetime(frame.pop('Date')))
+        return frame
+
+    async def arrays(self, symbol, start=None, end=None):
+        # 날짜 범위의 일봉을 컬럼별 NumPy 배열로 반환
+        rows = await storage.read(self._query, symbol.upper(), start, end)
+        dates, opens, highs, lows, closes, volumes = zip(*rows) if rows else ((),) * 6
+        return {
+            'date': np.array(dates, dtype='datetime64[D]'),
+            'open': np.array(opens, dtype=np.float64),
+            'high': np.array(highs, dtype=np.float64),
+            'low': np.array(lows, dtype=np.float64),
+            'close': np.array(closes, dtype=np.float64),
+            'volume': np.array(volumes, dtype=np.int64),
+        }
+
+    async def latest_closes(self, symbols):
+        # 장 마감 후 동기화된 심볼의 마지막 종가
+        fresh = [symbol for symbol in symbols if self.is_fresh(symbol)]
+        if not fresh:
+            return {}
+        rows = await db_fetchall(f'''
+        SELECT symbol, close FROM stock_data AS s
+        WHERE symbol IN ({','.join('?' * len(fresh))})
+        AND date = (SELECT MAX(date) FROM stock_data WHERE symbol = s.symbol)
+        ''', fresh)
+        return dict(rows)
+
+history_store = HistoryStore()
+
+# 분봉은 DB에 저장하지 않고 최근 며칠치만 메모리에 보관
+INTRADAY_PERIOD = '5d'
+INTRADAY_INTERVAL = '5m'
+INTRADAY_CACHE_SYMBOLS = 64
+
+# 심볼별 최근 분봉 캐시 (최신이면 다시 받지 않음, 오래 안 쓴 심볼부터 제거)
+class IntradayBars:
+    def __init__(self, max_symbols=INTRADAY_CACHE_SYMBOLS):
+        self.max_symbols = max_symbols
+        self._frames = OrderedDict()  # symbol -> (동기화 시각, DataFrame)
+
+    async def frame(self, symbol):
+        # 미 동부 시간 기준 tz 없는 DatetimeIndex DataFrame
+        symbol = symbol.upper()
+        entry = self._frames.get(symbol)
+        if entry is not None and is_synced(entry[0]):
+            self._frames.move_to_end(symbol)
+            return entry[1]
+        return await history_flight.do(('intraday', symbol), lambda: self._fetch(symbol))
+
+    async def _fetch(self, symbol):
+        fetched_at = datetime.now(tz=pytz.UTC).timestamp()
+        frame = (await run_io(fetch_history, symbol, period=INTRADAY_PERIOD, interval=INTRADAY_INTERVAL))[HISTORY_COLUMNS]
+        index = frame.index if frame.index.tz is not None else frame.index.tz_localize('UTC')
+        frame = frame.set_axis(index.tz_convert(EASTERN).tz_localize(None)).dropna()
+        self._frames[symbol] = (fetched_at, frame)
+        self._frames.move_to_end(symbol)
+        while len(self._frames) > self.max_symbols:
+            self._frames.popitem(last=False)
+        return frame
+
+intraday_bars = IntradayBars()
+
+# 평가용 시세 조회: 장이 닫혀 있으면 로컬 히스토리의 마지막 종가를 먼저 사용
+async def get_valuation_prices(symbols):
+    symbols = {symbol.upper() for symbol in symbols}
+    prices = {}
+    if not is_market_open():
+        prices = await history_store.latest_closes(symbols)
+    missing = symbols - prices.keys()
+    if missing:
+        prices.update(await fetch_stock_prices(missing))
+    return prices
+
+# 봉을 달력 기준 구간(pandas resample 규칙, 예: '30min', 'W-FRI')으로 묶음
+# 구간이 달력에 고정되어 있어 새 봉이 추가돼도 앞쪽 묶음은 바뀌지 않음
+def resample_bars(frame, rule):
+    if frame.empty:
+        return frame
+    bars = frame.resample(rule, label='left').agg({'Open': 'first', 'High': 'max', 'Low': 'min', 'Close': 'last', 'Volume': 'sum'})
+    return bars.dropna(subset=['Close'])
+
+# 수익률(%) 계산: 보너스를 제외한 순이익 / 순투자금 (스칼라와 NumPy 배열 모두 사용 가능)
+def calculate_profit_rate(total_assets, net_investment, total_bonus):
+    net_profit = np.asarray(total_assets - net_investment - total_bonus, dtype=np.float64)
+    net_investment = np.asarray(net_investment, dtype=np.float64)
+    profit_rate = np.divide(net_profit * 100, net_investment, out=np.zeros_like(net_profit), where=net_investment != 0)
+    return profit_rate if profit_rate.ndim else float(profit_rate)
+
 # 금액 포맷 함수
 def format_currency(value):
     return f"{value:,.2f}"
 
+# 환율 갱신 주기(시간)
+RATE_REFRESH_HOURS = 6
+
+# 환율을 한 번 읽어 메모리에 두고 통화쌍별 환율을 재사용하는 서비스
+class RateService:
+    def __init__(self):
+        self._converter = None
+        self._rates = {}  # (from, to) -> rate
+        self._lock = threading.Lock()
+
+    @timed('fx', 'load')
+    def load(self, currency_file=None):
+        from currency_converter import CurrencyConverter
+        # currency_file이 없으면 패키지에 포함된 ECB 환율 파일 사용
+        if currency_file:
+            converter = CurrencyConverter(currency_file, fallback_on_missing_rate=True, fallback_on_wrong_date=True)
+        else:
+            converter = CurrencyConverter(fallback_on_missing_rate=True, fallback_on_wrong_date=True)
+        with self._lock:
+            self._converter = converter
+            self._rates = {}
+
+    def refresh(self):
+        # 최신 ECB 환율을 내려받고, 실패하면 기존 환율 유지
+        from currency_converter import ECB_URL
+        try:
+            self.load(ECB_URL)
+        except Exception as e:
+            print(f"환율 갱신 실패: {e}")
+            if self._converter is None:
+                self.load()
+
+    def rate(self, from_currency, to_currency):
+        key = (from_currency, to_currency)
+        rate = self._rates.get(key)
+        if rate is None:
+            with self._lock:
+                with metrics.time('fx', 'rate'):
+                    if self._converter is None:
+                        from currency_converter import CurrencyConverter
+                        self._converter = CurrencyConverter(fallback_on_missing_rate=True, fallback_on_wrong_date=True)
+                    rate = self._rates[key] = self._converter.convert(1, from_currency, to_currency)
+        return rate
+
+    def convert(self, amount, from_currency, to_currency):
+        return amount * self.rate(from_currency, to_currency)
+
+    def convert_many(self, amounts, from_currency, to_currency):
+        return np.asarray(amounts, dtype=float) * self.rate(from_currency, to_currency)
+
+rate_service = RateService()
+
 # 환율 변환 함수
 def convert_currency(amount, from_currency, to_currency):
-    c = CurrencyConverter()
-    return c.convert(amount, from_currency, to_currency)
+    return rate_service.convert(amount, from_currency, to_currency)
+
+# 환율 주기적 갱신 태스크
+@tasks.loop(hours=RATE_REFRESH_HOURS)
+async def refresh_currency_rates():
+    await run_io(rate_service.refresh)
 
 # 보너스 쿨다운 체크 함수
 def check_bonus_cooldown(last_bonus_time):
@@ -130,171 +1017,560 @@ def check_bonus_cooldown(last_bonus_time):
         return datetime.now(tz=pytz.UTC) >= cooldown_end
     return True
 
-def is_holiday(date):
-    cal = USFederalHolidayCalendar()
-    holidays = cal.holidays(start=date.replace(year=date.year-1), end=date.replace(year=date.year+1))
-    return date in holidays
-
-# 시장 오픈 여부 체크 함수
-def is_market_open():
-    # 현재 시간 얻기
-    now = datetime.now(pytz.timezone('US/Eastern'))
-
-    # 요일 확인 (0 = 월요일, ..., 6 = 일요일)
-    if now.weekday() == 5 and now.time() >= time(5, 0):
-        return False
-    if now.weekday() == 6:
-        return False
-
-    # 거래 가능 시간 정의 (EST/EDT)
-    premarket_open = time(4, 0)
-    aftermarket_close = time(20, 0)
+# 미국 동부 시간대
+EASTERN = pytz.timezone('US/Eastern')
+
+# 거래 세션 시간 (동부 시간 기준)
+PREMARKET_OPEN = time(4, 0)
+REGULAR_OPEN = time(9, 30)
+REGULAR_CLOSE = time(16, 0)
+AFTERMARKET_CLOSE = time(20, 0)
+# 조기 폐장일 세션 마감 시간
+EARLY_REGULAR_CLOSE = time(13, 0)
+EARLY_AFTERMARKET_CLOSE = time(17, 0)
+
+# NYSE 휴장일 (연방 공휴일과 달리 Good Friday는 휴장, 콜럼버스/재향군인의 날은 개장)
+# pandas 휴일 달력은 처음 달력을 만들 때 불러옴
+def nyse_holidays(year):
+    from pandas.tseries.holiday import (
+        AbstractHolidayCalendar, Holiday, GoodFriday, USMartinLutherKingJr, USPresidentsDay,
+        USMemorialDay, USLaborDay, USThanksgivingDay, nearest_workday, sunday_to_monday,
+    )
 
-    # 현재 시간이 거래 가능 시간인지 확인
-    if not (premarket_open <= now.time() <= aftermarket_close):
-        return False
+    class NYSEHolidayCalendar(AbstractHolidayCalendar):
+        rules = [
+            Holiday('New Years Day', month=1, day=1, observance=sunday_to_monday),
+            USMartinLutherKingJr,
+            USPresidentsDay,
+            GoodFriday,
+            USMemorialDay,
+            Holiday('Juneteenth', month=6, day=19, start_date='2022-01-01', observance=nearest_workday),
+            Holiday('Independence Day', month=7, day=4, observance=nearest_workday),
+            USLaborDay,
+            USThanksgivingDay,
+            Holiday('Christmas', month=12, day=25, observance=nearest_workday),
+        ]
+
+    return NYSEHolidayCalendar().holidays(start=date(year, 1, 1), end=date(year, 12, 31))
+
+# 1년치 거래 세션을 미리 계산해두고 이진 탐색으로 조회하는 시장 달력
+class MarketCalendar:
+    SESSION_NAMES = ('premarket', 'regular', 'aftermarket')
+
+    def __init__(self, year):
+        self.year = year
+        holidays = nyse_holidays(year)
+        self.holidays = np.array(sorted(day.toordinal() for day in holidays.date), dtype=np.int64)
+        thanksgiving = next((day for day in holidays.date if day.month == 11), None)
+        early_closes = {date(year, 7, 3), date(year, 12, 24)}
+        if thanksgiving:
+            early_closes.add(thanksgiving + timedelta(days=1))
+
+        starts, ends, kinds = [], [], []
+        day = date(year, 1, 1)
+        while day.year == year:
+            if day.weekday() < 5 and not self.is_holiday(day):
+                early = day in early_closes
+                bounds = (
+                    PREMARKET_OPEN,
+                    REGULAR_OPEN,
+                    EARLY_REGULAR_CLOSE if early else REGULAR_CLOSE,
+                    EARLY_AFTERMARKET_CLOSE if early else AFTERMARKET_CLOSE,
+                )
+                instants = [EASTERN.localize(datetime.combine(day, t)).timestamp() for t in bounds]
+                for kind in range(3):
+                    starts.append(instants[kind])
+                    ends.append(instants[kind + 1])
+                    kinds.append(kind)
+            day += timedelta(days=1)
+        self.starts = np.array(starts, dtype=np.float64)
+        self.ends = np.array(ends, dtype=np.float64)
+        self.kinds = np.array(kinds, dtype=np.int8)
+
+    def is_holiday(self, day):
+        ordinal = day.toordinal()
+        i = int(np.searchsorted(self.holidays, ordinal))
+        return i < len(self.holidays) and self.holidays[i] == ordinal
+
+    def _index(self, ts):
+        # ts를 포함하는 세션의 인덱스, 없으면 -1
+        i = int(np.searchsorted(self.starts, ts, side='right')) - 1
+        if i >= 0 and ts < self.ends[i]:
+            return i
+        return -1
+
+    def session(self, now):
+        # 현재 세션 이름 ('premarket' / 'regular' / 'aftermarket'), 장이 닫혀 있으면 None
+        i = self._index(now.timestamp())
+        return self.SESSION_NAMES[self.kinds[i]] if i >= 0 else None
+
+    def is_open(self, now):
+        return self._index(now.timestamp()) >= 0
+
+    def previous_close(self, now):
+        # 지금 이전에 마지막으로 끝난 세션의 마감 시각 (올해 안에 없으면 None)
+        i = int(np.searchsorted(self.ends, now.timestamp(), side='right')) - 1
+        if i < 0:
+            return None
+        return datetime.fromtimestamp(self.ends[i], tz=pytz.UTC)
+
+    def next_open(self, now):
+        # 지금 이후 가장 가까운 세션 시작 시각 (올해 안에 없으면 None)
+        i = int(np.searchsorted(self.starts, now.timestamp(), side='right'))
+        if i >= len(self.starts):
+            return None
+        return datetime.fromtimestamp(self.starts[i], tz=pytz.UTC)
+
+    def time_until_close(self, now, session_only=False):
+        # 연속된 거래 시간(프리마켓 ~ 애프터마켓)이 끝날 때까지 남은 시간, 장이 닫혀 있으면 None
+        ts = now.timestamp()
+        i = self._index(ts)
+        if i < 0:
+            return None
+        if not session_only:
+            while i + 1 < len(self.starts) and self.starts[i + 1] == self.ends[i]:
+                i += 1
+        return timedelta(seconds=float(self.ends[i] - ts))
+
+_market_calendars = {}
+_market_calendar_lock = threading.Lock()
+
+# 연도별 시장 달력 (처음 요청될 때 한 번만 생성)
+def get_market_calendar(year=None):
+    if year is None:
+        year = datetime.now(EASTERN).year
+    calendar = _market_calendars.get(year)
+    if calendar is None:
+        with _market_calendar_lock:
+            calendar = _market_calendars.get(year)
+            if calendar is None:
+                calendar = _market_calendars[year] = MarketCalendar(year)
+    return calendar
 
-    # 휴장일 확인
-    if is_holiday(now.date()):
+def is_holiday(date):
+    return get_market_calendar(date.year).is_holiday(date)
+
+# 시장 오픈 여부 체크 함수 (프리마켓 ~ 애프터마켓)
+def is_market_open(now=None):
+    now = now or datetime.now(tz=pytz.UTC)
+    return get_market_calendar(now.astimezone(EASTERN).year).is_open(now)
+
+# 다음 세션 시작 시각 (연말이면 다음 해 달력까지 확인)
+def next_market_open(now=None):
+    now = now or datetime.now(tz=pytz.UTC)
+    year = now.astimezone(EASTERN).year
+    return get_market_calendar(year).next_open(now) or get_market_calendar(year + 1).next_open(now)
+
+# 직전 세션 마감 시각 (연초면 이전 해 달력까지 확인)
+def previous_market_close(now=None):
+    now = now or datetime.now(tz=pytz.UTC)
+    year = now.astimezone(EASTERN).year
+    return get_market_calendar(year).previous_close(now) or get_market_calendar(year - 1).previous_close(now)
+
+# 장 마감까지 남은 시간, 장이 닫혀 있으면 None
+def time_until_market_close(now=None):
+    now = now or datetime.now(tz=pytz.UTC)
+    return get_market_calendar(now.astimezone(EASTERN).year).time_until_close(now)
+
+# 유저 추가, 이미 있으면 False
+def insert_user(cur, user_id, initial_balance):
+    cur.execute("INSERT OR IGNORE INTO users (id, balance, initial_balance) VALUES (?, ?, ?)", (user_id, initial_balance, initial_balance))
+    if cur.rowcount != 1:
         return False
-
+    sync_portfolio(cur, user_id)
     return True
 
 # 유저 등록
 @bot.command(name='등록')
 async def register(ctx):
     user_id = ctx.author.id
-    c.execute("SELECT 1 FROM users WHERE id=?", (user_id,))
-    if c.fetchone():
+    initial_balance_usd = 1000
+    if not await storage.write(insert_user, user_id, initial_balance_usd):
         await ctx.reply(embed=discord.Embed(description=f"{ctx.author.display_name}님은 이미 등록되었습니다.", color=discord.Color.red()))
         return
-    initial_balance_usd = 1000
-    balance_krw = convert_currency(initial_balance_usd, 'USD', 'KRW')
-    c.execute("INSERT INTO users (id, balance, initial_balance) VALUES (?, ?, ?)", (user_id, initial_balance_usd, initial_balance_usd))
-    conn.commit()
-    user = await bot.fetch_user(user_id)
-    await ctx.reply(embed=discord.Embed(description=f"{user.display_name} 등록 완료! 초기 잔액은 ${initial_balance_usd} (원화: {format_currency(balance_krw)}원)입니다.", color=discord.Color.green()))
-
+    balance_krw = rate_service.convert(initial_balance_usd, 'USD', 'KRW')
+    display_names.remember(ctx.author)
+    await ctx.reply(embed=discord.Embed(description=f"{ctx.author.display_name} 등록 완료! 초기 잔액은 ${initial_balance_usd} (원화: {format_currency(balance_krw)}원)입니다.", color=discord.Color.green()))
+    await update_user_rank(user_id)
+
+
+# 페이지 이동 시 원래 메시지를 수정하는 페이지네이션 뷰
+# build_page(page)는 해당 페이지의 Embed를 만드는 코루틴 함수이며, 만든 페이지는 뷰가 살아있는 동안 재사용
+class Paginator(View):
+    def __init__(self, page_count, build_page, timeout=300):
+        super().__init__(timeout=timeout)
+        self.page_count = max(page_count, 1)
+        self.build_page = build_page
+        self.page = 0
+        self.message = None
+        self._pages = {}  # page -> 페이지 Embed를 만드는 Task (같은 페이지를 동시에 눌러도 한 번만 생성)
+        self.prev_button = Button(label="이전", style=discord.ButtonStyle.primary)
+        self.prev_button.callback = lambda interaction: self.show(interaction, self.page - 1)
+        self.next_button = Button(label="다음", style=discord.ButtonStyle.primary)
+        self.next_button.callback = lambda interaction: self.show(interaction, self.page + 1)
+        self.add_item(self.prev_button)
+        self.add_item(self.next_button)
+
+    async def render(self, page):
+        task = self._pages.get(page)
+        if task is None or (task.done() and task.exception() is not None):
+            task = self._pages[page] = asyncio.ensure_future(self.build_page(page))
+        embed = await asyncio.shield(task)
+        embed.set_footer(text=f"페이지 {page + 1}/{self.page_count}")
+        return embed
+
+    def _update_buttons(self):
+        self.prev_button.disabled = self.page <= 0
+        self.next_button.disabled = self.page >= self.page_count - 1
+
+    async def start(self, ctx):
+        embed = await self.render(0)
+        if self.page_count == 1:
+            self.stop()
+            await ctx.reply(embed=embed)
+            return
+        self._update_buttons()
+        self.message = await ctx.reply(embed=embed, view=self)
+
+    async def show(self, interaction, page):
+        # 페이지를 만들 때 시세/유저 조회가 3초를 넘을 수 있으므로 먼저 응답을 미뤄둠
+        await interaction.response.defer()
+        page = min(max(page, 0), self.page_count - 1)
+        embed = await self.render(page)
+        self.page = page
+        self._update_buttons()
+        await interaction.edit_original_response(embed=embed, view=self)
+
+    async def on_timeout(self):
+        # 만료되면 버튼 비활성화
+        self.prev_button.disabled = self.next_button.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
+
+# 자산 페이지당 보유 종목 수
+ASSETS_PER_PAGE = 10
+
+# 총 자산/수익률과 평가 시각: 리더보드 스냅샷의 평가액을 사용하고 (거래할 때마다 update_user_rank가 갱신)
+# 스냅샷에 없을 때만 이 유저의 보유 종목 전체를 평가
+async def get_user_valuation(user_id):
+    entry = leaderboard_snapshot.entry(user_id)
+    if entry is not None:
+        return entry + (leaderboard_snapshot.valued_at(user_id),)
+    matrix = await get_user_portfolio_matrix(user_id)
+    prices = await get_valuation_prices(matrix.symbols.tolist())
+    (_, total_usd, total_krw, profit_rate), = rank_users(matrix, prices)
+    return total_usd, total_krw, profit_rate, datetime.now(tz=pytz.UTC)
 
 # 자산 명령어
 @bot.command(name='자산')
 async def assets(ctx):
     user_id = ctx.author.id
-    c.execute("SELECT balance, initial_balance, total_bonus FROM users WHERE id=?", (user_id,))
-    result = c.fetchone()
-    if not result:
+    account = await get_user_account(user_id)
+    if not account:
         await ctx.reply(embed=discord.Embed(description="등록되지 않은 사용자입니다. 먼저 `w!등록` 명령어로 등록해주세요.", color=discord.Color.red()))
         return
 
-    balance, initial_balance, total_bonus = result
-    c.execute("SELECT stock_symbol, shares, average_price FROM stocks WHERE user_id=?", (user_id,))
-    stocks = c.fetchall()
-
-    # Calculate total value in KRW and USD
-    total_balance_usd = balance
-    stock_details = []
-
-    for stock_symbol, shares, average_price in stocks:
-        stock = yf.Ticker(stock_symbol)
-        stock_info = stock.history(period="1d")
-        if not stock_info.empty:
-            current_price = stock_info['Close'].iloc[-1]
+    balance = account[0]
+    stocks = await get_user_holdings(user_id)
+    total_balance_usd, total_balance_krw, total_profit_rate, valued_at = await get_user_valuation(user_id)
+    balance_krw = rate_service.convert(balance, 'USD', 'KRW')
+
+    # 보이는 페이지의 보유 종목만 평가
+    async def build_page(page):
+        embed = discord.Embed(title=f"{ctx.author.display_name}님의 자산 현황", color=discord.Color.blue())
+        embed.add_field(name="잔고", value=f"${format_currency(balance)} (₩{format_currency(balance_krw)})", inline=False)
+
+        page_stocks = stocks[page * ASSETS_PER_PAGE:(page + 1) * ASSETS_PER_PAGE]
+        prices = await get_valuation_prices(stock_symbol for stock_symbol, _, _ in page_stocks)
+        priced = [(stock_symbol, shares, average_price, prices[stock_symbol]) for stock_symbol, shares, average_price in page_stocks if stock_symbol in prices]
+        prices_krw = rate_service.convert_many([current_price for _, _, _, current_price in priced], 'USD', 'KRW')
+        for (stock_symbol, shares, average_price, current_price), price_krw in zip(priced, prices_krw):
             total_stock_value = shares * current_price
-            total_balance_usd += total_stock_value
-            price_krw = convert_currency(current_price, 'USD', 'KRW')
-            stock_value_krw = convert_currency(total_stock_value, 'USD', 'KRW')
+            stock_value_krw = price_krw * shares
             profit_rate = ((current_price - average_price) / average_price) * 100
-            stock_details.append(f"{stock_symbol}: {shares}주 (현재 가격: {format_currency(price_krw)}원 (${current_price:.2f}), 가치: {format_currency(stock_value_krw)}원 (${total_stock_value:.2f}), 수익률: {profit_rate:.2f}%)")
+            embed.add_field(name="보유 주식", value=f"{stock_symbol}: {shares}주 (현재 가격: {format_currency(price_krw)}원 (${current_price:.2f}), 가치: {format_currency(stock_value_krw)}원 (${total_stock_value:.2f}), 수익률: {profit_rate:.2f}%)", inline=False)
 
-    total_balance_krw = convert_currency(total_balance_usd, 'USD', 'KRW')
-    initial_balance_krw = convert_currency(initial_balance, 'USD', 'KRW')
+        embed.add_field(name="총 자산", value=f"${format_currency(total_balance_usd)} (₩{format_currency(total_balance_krw)}) ({total_profit_rate:.2f}%)\n<t:{int(valued_at.timestamp())}:R> 기준 시세로 평가", inline=False)
+        return embed
 
-    # Calculate profit rate excluding bonus and pending limit orders
-    c.execute("SELECT SUM(shares * price) FROM limit_orders WHERE user_id=? AND order_type='buy'", (user_id,))
-    pending_buy_orders = c.fetchone()[0] or 0
+    await Paginator(math.ceil(len(stocks) / ASSETS_PER_PAGE), build_page).start(ctx)
 
-    # Sum of investments excluding pending buy orders
-    investments_sum = initial_balance + sum(average_price * shares for _, shares, average_price in stocks)
-    
-    # Calculate net profit excluding bonuses and pending buy orders
-    net_profit_usd = total_balance_usd - investments_sum - total_bonus
-    
-    # Calculate profit rate
-    profit_rate = (net_profit_usd / investments_sum) * 100 if investments_sum != 0 else 0
-
-    embed = discord.Embed(title=f"{ctx.author.display_name}님의 자산 현황", color=discord.Color.blue())
-    embed.add_field(name="잔고", value=f"${format_currency(balance)} (₩{format_currency(convert_currency(balance, 'USD', 'KRW'))})", inline=False)
-
-    if stock_details:
-        for detail in stock_details:
-            embed.add_field(name="보유 주식", value=detail, inline=False)
-
-    embed.add_field(name="총 자산", value=f"${format_currency(total_balance_usd)} (₩{format_currency(total_balance_krw)}) ({profit_rate:.2f}%)", inline=False)
-
-    await ctx.reply(embed=embed)
-
-    # 자산 페이지네이션 함수
-async def paginate_assets(ctx, embed, stock_details, page=0):
-    max_per_page = 10
-    stock_page = stock_details[page * max_per_page:(page + 1) * max_per_page]
+# 렌더링된 차트 캐시 최대 크기(바이트)
+CHART_CACHE_MAX_BYTES = int(os.environ.get('MOCK_INVEST_CHART_CACHE_BYTES', 32 * 1024 * 1024))
 
-    for detail in stock_page:
-        embed.add_field(name="\u200b", value=detail, inline=False)
+# 봇 시작 시 프로세스 풀 워커를 모두 띄워둠
+async def warm_cpu_pool():
+    await asyncio.gather(*(run_cpu(charts.chart_worker_pid) for _ in range(CPU_POOL_SIZE)))
 
-    view = View()
-    if page > 0:
-        prev_button = Button(label="이전", style=discord.ButtonStyle.primary)
-        prev_button.callback = lambda interaction: paginate_assets(ctx, embed, stock_details, page - 1)
-        view.add_item(prev_button)
+# 렌더링된 PNG를 (심볼, 기간, 간격, 마지막 봉) 키로 보관하는 LRU 캐시 (총 바이트 수 제한)
+# 같은 키를 렌더링 중이면 새로 렌더링하지 않고 그 결과를 기다림 (SingleFlight)
+class ChartCache:
+    def __init__(self, max_bytes=CHART_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # key -> png bytes
+        self.flight = SingleFlight('chart')
 
-    if (page + 1) * max_per_page < len(stock_details):
-        next_button = Button(label="다음", style=discord.ButtonStyle.primary)
-        next_button.callback = lambda interaction: paginate_assets(ctx, embed, stock_details, page + 1)
-        view.add_item(next_button)
+    def get(self, key):
+        png = self._entries.get(key)
+        if png is not None:
+            self._entries.move_to_end(key)
+        return png
 
-    await ctx.reply(embed=embed, view=view)
+    def put(self, key, png):
+        if len(png) > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key))
+        self._entries[key] = png
+        self.size += len(png)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    async def get_or_render(self, key, render):
+        # render: PNG 바이트를 돌려주는 코루틴 함수
+        png = self.get(key)
+        if png is not None:
+            return png
+        return await self.flight.do(key, lambda: self._render(key, render))
+
+    async def _render(self, key, render):
+        png = await render()
+        self.put(key, png)
+        return png
+
+chart_cache = ChartCache()
+
+# 기술적 지표 설정: 이동평균 기간, 볼린저 밴드 (기간, 표준편차 배수), RSI 기간, MACD (단기, 장기, 시그널)
+MA_WINDOWS = (20, 60)
+BOLLINGER_WINDOW = 20
+BOLLINGER_WIDTH = 2
+RSI_PERIOD = 14
+MACD_FAST = 12
+MACD_SLOW = 26
+MACD_SIGNAL = 9
+# 지표를 보관할 (심볼, 차트 기간) 수
+INDICATOR_CACHE_SIZE = 256
+
+# 열 방향 단순 이동평균 (앞쪽 window - 1개는 NaN)
+def rolling_mean(values, window):
+    cumsum = np.cumsum(values, axis=0)
+    result = np.full(values.shape, np.nan)
+    if len(values) >= window:
+        result[window - 1] = cumsum[window - 1] / window
+        result[window:] = (cumsum[window:] - cumsum[:-window]) / window
+    return result
+
+# 이동 표준편차 (앞쪽 window - 1개는 NaN)
+def rolling_std(values, window):
+    result = np.full(len(values), np.nan)
+    if len(values) >= window:
+        result[window - 1:] = np.lib.stride_tricks.sliding_window_view(values, window).std(axis=1)
+    return result
+
+# 지수 이동평균 y[t] = alpha * x[t] + (1 - alpha) * y[t-1], initial이 있으면 그 값에서 이어서 계산
+def ema(values, alpha, initial=None):
+    if initial is not None:
+        values = np.concatenate(([initial], values))
+    result = pd.Series(values, dtype=np.float64).ewm(alpha=alpha, adjust=False).mean().to_numpy()
+    return result[1:] if initial is not None else result
+
+# 종가 배열로 이동평균/볼린저 밴드/RSI/MACD 계산
+# previous가 있으면 start 이전 값은 그대로 쓰고 start부터만 계산 (이동 창은 필요한 만큼 앞 값을 포함, 지수 이동평균은 직전 값에서 이어감)
+def compute_indicators(close, previous=None, start=0):
+    if previous is None:
+        start = 0
+    n = len(close)
+
+    def rolling(func, window):
+        lo = max(start - window + 1, 0)
+        return func(close[lo:], window)[start - lo:]
+
+    def continue_ema(name, values, alpha):
+        return ema(values, alpha, previous[name][start - 1] if start else None)
+
+    fresh = {f'ma{window}': rolling(rolling_mean, window) for window in MA_WINDOWS}
+    middle = rolling(rolling_mean, BOLLINGER_WINDOW)
+    width = BOLLINGER_WIDTH * rolling(rolling_std, BOLLINGER_WINDOW)
+    fresh['bb_upper'] = middle + width
+    fresh['bb_lower'] = middle - width
+
+    # RSI: 상승/하락폭의 와일더 평균 (처음 RSI_PERIOD개는 NaN)
+    delta = np.diff(close[max(start - 1, 0):])
+    if not start:
+        delta = np.concatenate(([0.0], delta))
+    fresh['avg_gain'] = continue_ema('avg_gain', np.maximum(delta, 0), 1 / RSI_PERIOD)
+    fresh['avg_loss'] = continue_ema('avg_loss', np.maximum(-delta, 0), 1 / RSI_PERIOD)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rsi = 100 - 100 / (1 + fresh['avg_gain'] / fresh['avg_loss'])
+    rsi[fresh['avg_loss'] == 0] = 100.0
+    rsi[np.arange(start, n) < RSI_PERIOD] = np.nan
+    fresh['rsi'] = rsi
+
+    # MACD: 단기 EMA - 장기 EMA, 시그널은 MACD의 EMA
+    fresh['ema_fast'] = continue_ema('ema_fast', close[start:], 2 / (MACD_FAST + 1))
+    fresh['ema_slow'] = continue_ema('ema_slow', close[start:], 2 / (MACD_SLOW + 1))
+    fresh['macd'] = fresh['ema_fast'] - fresh['ema_slow']
+    fresh['macd_signal'] = continue_ema('macd_signal', fresh['macd'], 2 / (MACD_SIGNAL + 1))
+    fresh['macd_hist'] = fresh['macd'] - fresh['macd_signal']
+
+    if not start:
+        return fresh
+    return {name: np.concatenate((previous[name][:start], values)) for name, values in fresh.items()}
+
+# (심볼, 차트 기간)별 지표 캐시
+# 이전에 계산한 봉들이 그대로 있으면 마지막 봉(장중에 바뀌었을 수 있음)과 새로 추가된 봉만 다시 계산
+class IndicatorCache:
+    def __init__(self, max_entries=INDICATOR_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (symbol, timeframe) -> (봉 시각 배열, 종가 배열, 지표 dict)
+        self.hits = 0
+        self.partial = 0
+        self.full = 0
+
+    def get(self, symbol, timeframe, timestamps, close):
+        key = (symbol, timeframe)
+        cached = self._entries.get(key)
+        start = 0
+        if cached is not None:
+            cached_timestamps, cached_close, indicators = cached
+            count = len(cached_timestamps)
+            if (count <= len(timestamps) and np.array_equal(timestamps[:count], cached_timestamps)
+                    and np.array_equal(close[:count - 1], cached_close[:-1])):
+                if count == len(timestamps) and close[-1] == cached_close[-1]:
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return indicators
+                start = count - 1
+        if start:
+            self.partial += 1
+            indicators = compute_indicators(close, cached[2], start)
+        else:
+            self.full += 1
+            indicators = compute_indicators(close)
+        self._entries[key] = (timestamps.copy(), close.copy(), indicators)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return indicators
+
+indicator_cache = IndicatorCache()
+
+# 차트 기간: 이름 -> (봉 종류, 표시 기간(일), 묶는 규칙), 1D는 마지막 거래일 하루치
+CHART_TIMEFRAMES = {
+    '1D': ('intraday', 1, None),
+    '1W': ('intraday', 7, '30min'),
+    '3M': ('daily', 92, None),
+    '1Y': ('daily', 365, None),
+    '5Y': ('daily', 5 * 365, 'W-FRI'),
+}
+DEFAULT_CHART_TIMEFRAME = '3M'
 
 class StockView(View):
-    def __init__(self, symbol):
+    def __init__(self, symbol, timeframe=DEFAULT_CHART_TIMEFRAME):
         super().__init__(timeout=300)  # 5분 후 만료
         self.symbol = symbol.upper()
-
-    async def update_graph(self, ctx):
-        # 주식 데이터 가져오기
-        stock = yf.Ticker(self.symbol)
-        hist = stock.history(period="3mo", interval="5d")
-
-        if hist.empty:
-            await ctx.reply("주식 데이터를 가져올 수 없습니다.")
-            return
-
-        # 캔들 차트 생성
-        fig, ax = plt.subplots()
-        hist['Date'] = mdates.date2num(hist.index.to_pydatetime())
-        ohlc = hist[['Date', 'Open', 'High', 'Low', 'Close']]
-        mpf.plot(ohlc, type='candle', ax=ax, style='charles')
-        ax.set_title(f"{self.symbol} 3 Months candle")
-        ax.set_xlabel('Date')
-        ax.set_ylabel('Price (USD)')
-
-        # 그래프를 임시 파일에 저장
-        buf = BytesIO()
-        plt.savefig(buf, format='png')
-        buf.seek(0)
-        plt.close(fig)
-
-        # 이미지를 디스코드에 업로드하고 메시지 업데이트
-        file = discord.File(buf, filename=f"{self.symbol}_chart.png")
-        price = hist['Close'].iloc[-1]
-        price_krw = convert_currency(price, 'USD', 'KRW')
+        self.timeframe = timeframe
+        self.message = None
+        self._frames = {}  # 봉 종류 -> DataFrame (뷰가 살아있는 동안 기간을 바꿔도 다시 읽지 않음)
+        self.buttons = {}
+        for name in CHART_TIMEFRAMES:
+            button = Button(label=name, style=discord.ButtonStyle.secondary)
+            button.callback = partial(self.select, name)
+            self.buttons[name] = button
+            self.add_item(button)
+
+    async def load_frame(self, source):
+        frame = self._frames.get(source)
+        if frame is None:
+            if source == 'intraday':
+                frame = await intraday_bars.frame(self.symbol)
+            else:
+                await history_store.sync(self.symbol)
+                frame = await history_store.frame(self.symbol)
+            self._frames[source] = frame
+        return frame
+
+    async def render(self):
+        # 현재 기간의 (Embed, File), 데이터가 없으면 None
+        source, days, rule = CHART_TIMEFRAMES[self.timeframe]
+        bars = await self.load_frame(source)
+        if rule is not None:
+            bars = resample_bars(bars, rule)
+        if bars.empty:
+            return None
+
+        # 지표는 저장된 전체 봉으로 계산한 뒤 표시 기간만 잘라서 그림 (기간 앞쪽도 이동평균이 채워짐)
+        close = bars['Close'].to_numpy(dtype=np.float64)
+        indicators = indicator_cache.get(self.symbol, self.timeframe, bars.index.asi8, close)
+        last = bars.index[-1]
+        first = last.normalize() if days == 1 else last - pd.Timedelta(days=days)
+        i = int(bars.index.searchsorted(first))
+        bars = bars.iloc[i:]
+        visible = {name: values[i:] for name, values in indicators.items()}
+
+        # 같은 봉 기준 차트는 캐시된 이미지 재사용 (장중에는 마지막 봉의 종가가 바뀌므로 종가도 키에 포함)
+        key = (self.symbol, self.timeframe, last.value, float(close[-1]))
+        async def render():
+            with metrics.time('render', 'candle'):
+                return await run_cpu(charts.render_candle_chart, self.symbol, self.timeframe, bars, visible)
+        png = await chart_cache.get_or_render(key, render)
+
+        file = discord.File(BytesIO(png), filename=f"{self.symbol}_chart.png")
+        price = close[-1]
+        price_krw = rate_service.convert(price, 'USD', 'KRW')
         embed = discord.Embed(
-            title=f"{self.symbol} 주식 정보",
+            title=f"{self.symbol} 주식 정보 ({self.timeframe})",
             description=f"현재 가격: ${price:.2f} ({format_currency(price_krw)}원)",
             color=discord.Color.blue()
         )
+        rsi, macd, signal = indicators['rsi'][-1], indicators['macd'][-1], indicators['macd_signal'][-1]
+        embed.add_field(name="RSI", value="-" if np.isnan(rsi) else f"{rsi:.1f}", inline=True)
+        embed.add_field(name="MACD / 시그널", value=f"{macd:.2f} / {signal:.2f}", inline=True)
         embed.set_image(url=f"attachment://{self.symbol}_chart.png")
+        return embed, file
+
+    def _update_buttons(self):
+        for name, button in self.buttons.items():
+            button.disabled = name == self.timeframe
+            button.style = discord.ButtonStyle.primary if name == self.timeframe else discord.ButtonStyle.secondary
 
-        await ctx.reply(embed=embed, file=file, view=self)
+    async def update_graph(self, ctx):
+        rendered = await self.render()
+        if rendered is None:
+            await ctx.reply("주식 데이터를 가져올 수 없습니다.")
+            return
+        embed, file = rendered
+        self._update_buttons()
+        self.message = await ctx.reply(embed=embed, file=file, view=self)
+
+    async def select(self, timeframe, interaction):
+        # 기간 버튼: 같은 메시지의 차트를 교체
+        # 분봉 다운로드와 렌더링이 3초를 넘을 수 있으므로 먼저 응답을 미뤄둠
+        await interaction.response.defer()
+        previous, self.timeframe = self.timeframe, timeframe
+        rendered = await self.render()
+        if rendered is None:
+            self.timeframe = previous
+            await interaction.followup.send("주식 데이터를 가져올 수 없습니다.", ephemeral=True)
+            return
+        embed, file = rendered
+        self._update_buttons()
+        await interaction.edit_original_response(embed=embed, attachments=[file], view=self)
+
+    async def on_timeout(self):
+        # 만료되면 버튼 비활성화
+        for button in self.buttons.values():
+            button.disabled = True
+        if self.message is not None:
+            try:
+                await self.message.edit(view=self)
+            except discord.HTTPException:
+                pass
 
 @bot.command(name='주식')
 async def stock(ctx, symbol: str):
@@ -303,187 +1579,663 @@ async def stock(ctx, symbol: str):
     await view.update_graph(ctx)  # 초기 그래프 생성 및 메시지 전송
 
 
+# 즉시 매수 체결 (잔고, 보유 주식, 거래 내역을 하나의 트랜잭션으로 처리)
+# 반환: ('ok', 남은 잔고) / ('unregistered', None) / ('insufficient', 현재 잔고)
+def execute_buy(cur, user_id, symbol, shares, price):
+    result = cur.execute("SELECT balance FROM users WHERE id=?", (user_id,)).fetchone()
+    if not result:
+        return 'unregistered', None
+    balance = result[0]
+    total_cost_usd = price * shares
+    if balance < total_cost_usd:
+        return 'insufficient', balance
+
+    cur.execute("UPDATE users SET balance = balance - ? WHERE id=?", (total_cost_usd, user_id))
+    cur.execute("""
+    INSERT INTO stocks (user_id, stock_symbol, shares, average_price)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id, stock_symbol)
+    DO UPDATE SET shares = shares + ?, average_price = (average_price * shares + ?)/(shares + ?)
+    """, (user_id, symbol, shares, price, shares, total_cost_usd, shares))
+    record_transaction(cur, user_id, symbol, shares, price, 'buy')
+    sync_portfolio(cur, user_id, symbol)
+    return 'ok', balance - total_cost_usd
+
+# 즉시 매도 체결 (수수료 0.1% 적용)
+# 반환: ('ok', 평균 매수가) / ('not_held', None) / ('insufficient', 보유 수량)
+def execute_sell(cur, user_id, symbol, shares, price):
+    result = cur.execute("SELECT shares, average_price FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol)).fetchone()
+    if not result:
+        return 'not_held', None
+    current_shares, average_price = result
+    if shares > current_shares:
+        return 'insufficient', current_shares
+
+    cur.execute("UPDATE users SET balance = balance + ? WHERE id=?", (price * shares * 0.999, user_id))
+    if shares == current_shares:
+        cur.execute("DELETE FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol))
+    else:
+        cur.execute("UPDATE stocks SET shares = shares - ? WHERE user_id=? AND stock_symbol=?", (shares, user_id, symbol))
+    record_transaction(cur, user_id, symbol, shares, price, 'sell')
+    sync_portfolio(cur, user_id, symbol)
+    return 'ok', average_price
+
 #즉시구매하기
 @bot.command(name='구매')
 async def buy(ctx, symbol: str, shares: int):
-    if not is_market_open():  
+    if not is_market_open():
         await ctx.reply(embed=discord.Embed(description="시장 시간이 아닙니다. 시장이 열렸을 때 시도해주세요.(프리마켓 ~ 애프터마켓의 영업일인 평일)", color=discord.Color.red()))
         return
 
     symbol = symbol.upper()
     user_id = ctx.author.id
-    price = get_stock_price(symbol)
+    price = await fetch_stock_price(symbol)
     if price:
         total_cost_usd = price * shares
-        c.execute("SELECT balance FROM users WHERE id=?", (user_id,))
-        result = c.fetchone()
-        if result:
-            balance = result[0]
-            if balance >= total_cost_usd:
-                average_price = total_cost_usd / shares
-
-                c.execute("UPDATE users SET balance = balance - ? WHERE id=?", (total_cost_usd, user_id))
-                c.execute("""
-                INSERT INTO stocks (user_id, stock_symbol, shares, average_price)
-                VALUES (?, ?, ?, ?)
-                ON CONFLICT(user_id, stock_symbol)
-                DO UPDATE SET shares = shares + ?, average_price = (average_price * shares + ?)/(shares + ?)
-                """, (user_id, symbol, shares, average_price, shares, total_cost_usd, shares))
-
-                conn.commit()
-                await ctx.reply(embed=discord.Embed(
-                    description=f"""
-                    **{ctx.author.display_name}님이 {symbol} 주식을 {shares}주 구매했습니다.**
-                    **총 비용: ${total_cost_usd:,.2f}**
-                    **1주당 평균 가격: ${price:,.2f}**
-                    """,
-                    color=discord.Color.green()
-                ))
-            else:
-                await ctx.reply(embed=discord.Embed(
-                    description=f"""
-                    **{ctx.author.display_name}님의 잔액이 부족합니다.**
-                    **현재 소지금: ${balance:,.2f}**
-                    **주문한 총 주식 금액: ${total_cost_usd:,.2f}**
-                    """,
-                    color=discord.Color.red()
-                ))
+        status, balance = await storage.write(execute_buy, user_id, symbol, shares, price)
+        if status == 'ok':
+            await ctx.reply(embed=discord.Embed(
+                description=f"""
+                **{ctx.author.display_name}님이 {symbol} 주식을 {shares}주 구매했습니다.**
+                **총 비용: ${total_cost_usd:,.2f}**
+                **1주당 평균 가격: ${price:,.2f}**
+                """,
+                color=discord.Color.green()
+            ))
+            await update_user_rank(user_id)
+        elif status == 'insufficient':
+            await ctx.reply(embed=discord.Embed(
+                description=f"""
+                **{ctx.author.display_name}님의 잔액이 부족합니다.**
+                **현재 소지금: ${balance:,.2f}**
+                **주문한 총 주식 금액: ${total_cost_usd:,.2f}**
+                """,
+                color=discord.Color.red()
+            ))
         else:
             await ctx.reply(embed=discord.Embed(description=f"**{ctx.author.display_name} 등록되지 않았습니다. w!등록 명령어로 등록해주세요.**", color=discord.Color.red()))
     else:
         await ctx.reply(embed=discord.Embed(description=f"**유효하지 않은 주식 기호입니다.**", color=discord.Color.red()))
 
 @bot.command(name='판매')
-async def buy(ctx, symbol: str, shares: int):
-    if not is_market_open():  
+async def sell(ctx, symbol: str, shares: int):
+    if not is_market_open():
         await ctx.reply(embed=discord.Embed(description="시장 시간이 아닙니다. 시장이 열렸을 때 시도해주세요.(프리마켓 ~ 애프터마켓의 영업일인 평일)", color=discord.Color.red()))
         return
 
     symbol = symbol.upper()
     user_id = ctx.author.id
-    price = get_stock_price(symbol)
+    price = await fetch_stock_price(symbol)
     if price:
-        c.execute("SELECT shares, average_price FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol))
-        result = c.fetchone()
-        if result:
-            current_shares, average_price = result
-            if shares <= current_shares:
-                total_sale_usd = price * shares
-                total_sale_usd_after_fee = total_sale_usd * 0.999  # 수수료 0.1% 적용
-                c.execute("UPDATE users SET balance = balance + ? WHERE id=?", (total_sale_usd_after_fee, user_id))
-                if shares == current_shares:
-                    c.execute("DELETE FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol))
-                else:
-                    c.execute("UPDATE stocks SET shares = shares - ? WHERE user_id=? AND stock_symbol=?", (shares, user_id, symbol))
-
-                conn.commit()
-                original_investment_usd = average_price * shares
-                total_profit_usd = total_sale_usd_after_fee - original_investment_usd
-                profit_rate = (total_profit_usd / original_investment_usd) * 100
-
-                record_transaction(user_id, symbol, shares, price, 'sell')
-
-                await ctx.reply(embed=discord.Embed(
-                    description=f"""
-                    **{ctx.author.display_name}님이 {symbol} 주식을 {shares}주 판매했습니다.**
-                    **1주당 판매 가격: ${price:,.2f}**
-                    **총 판매 금액: ${total_sale_usd:,.2f}**
-                    **수수료 후 금액: ${total_sale_usd_after_fee:,.2f}**
-                    **최종 수익: ${total_profit_usd:,.2f}**
-                    **수익률: {profit_rate:.2f}%**
-                    """,
-                    color=discord.Color.green()
-                ))
-            else:
-                await ctx.reply(embed=discord.Embed(description=f"**{ctx.author.display_name}님의 보유 주식 수량이 부족합니다.**", color=discord.Color.red()))
+        status, average_price = await storage.write(execute_sell, user_id, symbol, shares, price)
+        if status == 'ok':
+            total_sale_usd = price * shares
+            total_sale_usd_after_fee = total_sale_usd * 0.999  # 수수료 0.1% 적용
+            original_investment_usd = average_price * shares
+            total_profit_usd = total_sale_usd_after_fee - original_investment_usd
+            profit_rate = (total_profit_usd / original_investment_usd) * 100
+
+            await ctx.reply(embed=discord.Embed(
+                description=f"""
+                **{ctx.author.display_name}님이 {symbol} 주식을 {shares}주 판매했습니다.**
+                **1주당 판매 가격: ${price:,.2f}**
+                **총 판매 금액: ${total_sale_usd:,.2f}**
+                **수수료 후 금액: ${total_sale_usd_after_fee:,.2f}**
+                **최종 수익: ${total_profit_usd:,.2f}**
+                **수익률: {profit_rate:.2f}%**
+                """,
+                color=discord.Color.green()
+            ))
+            await update_user_rank(user_id)
+        elif status == 'insufficient':
+            await ctx.reply(embed=discord.Embed(description=f"**{ctx.author.display_name}님의 보유 주식 수량이 부족합니다.**", color=discord.Color.red()))
         else:
             await ctx.reply(embed=discord.Embed(description=f"**{symbol} 주식을 보유하고 있지 않습니다.**", color=discord.Color.red()))
     else:
         await ctx.reply(embed=discord.Embed(description=f"**유효하지 않은 주식 기호입니다.**", color=discord.Color.red()))
 
-'''
-@bot.command(name='예약매수')
-async def limit_buy(ctx, symbol: str, shares: int, price: float):
-    if not is_market_open():  
+# 일괄 주문 최대 종목 수
+BASKET_MAX_LEGS = 20
+
+# 일괄 주문 인자 파싱: "AAPL:10 MSFT:-5" -> [(심볼, 수량)], 양수는 매수, 음수는 매도 (같은 심볼은 합산)
+def parse_basket(orders):
+    legs = {}
+    for order in orders:
+        symbol, sep, shares = order.partition(':')
+        try:
+            shares = int(shares)
+        except ValueError:
+            shares = 0
+        if not sep or not symbol or shares == 0:
+            raise ValueError(f"잘못된 주문 형식입니다: `{order}` (예: AAPL:10, MSFT:-5)")
+        symbol = symbol.upper()
+        legs[symbol] = legs.get(symbol, 0) + shares
+    return [(symbol, shares) for symbol, shares in legs.items() if shares != 0]
+
+# 일괄 주문 체결: 전체 주문을 먼저 검증한 뒤 매도 -> 매수 순서로 적용 (하나의 쓰기 트랜잭션 안에서 호출)
+# legs: [(심볼, 수량, 가격)], 매도 대금(수수료 후)은 같은 주문의 매수에 사용 가능
+# 반환: ('ok', 체결 후 잔고) / ('unregistered', None) / ('not_held', 심볼)
+#       / ('insufficient_shares', (심볼, 보유 수량)) / ('insufficient', (사용 가능 금액, 필요 금액))
+def execute_basket(cur, user_id, legs):
+    result = cur.execute("SELECT balance FROM users WHERE id=?", (user_id,)).fetchone()
+    if not result:
+        return 'unregistered', None
+    balance = result[0]
+
+    sells = [(symbol, -shares, price) for symbol, shares, price in legs if shares < 0]
+    buys = [(symbol, shares, price) for symbol, shares, price in legs if shares > 0]
+    held = dict(cur.execute(
+        f"SELECT stock_symbol, shares FROM stocks WHERE user_id=? AND stock_symbol IN ({','.join('?' * len(sells))})",
+        (user_id, *(symbol for symbol, _, _ in sells)),
+    ).fetchall()) if sells else {}
+    for symbol, shares, _ in sells:
+        if symbol not in held:
+            return 'not_held', symbol
+        if shares > held[symbol]:
+            return 'insufficient_shares', (symbol, held[symbol])
+
+    proceeds = sum(price * shares * 0.999 for _, shares, price in sells)
+    cost = sum(price * shares for _, shares, price in buys)
+    if balance + proceeds < cost:
+        return 'insufficient', (balance + proceeds, cost)
+
+    for symbol, shares, price in sells:
+        execute_sell(cur, user_id, symbol, shares, price)
+    for symbol, shares, price in buys:
+        status, _ = execute_buy(cur, user_id, symbol, shares, price)
+        if status != 'ok':
+            # 부동소수점 오차로 검증과 결과가 어긋나면 전체 주문을 되돌림
+            raise ValueError("일괄 주문을 처리하지 못했습니다. 다시 시도해주세요.")
+    return 'ok', balance + proceeds - cost
+
+# 일괄 주문 (여러 종목을 한 번의 시세 조회와 한 번의 트랜잭션으로 매수/매도)
+@bot.command(name='일괄주문')
+async def basket_order(ctx, *orders: str):
+    if not is_market_open():
         await ctx.reply(embed=discord.Embed(description="시장 시간이 아닙니다. 시장이 열렸을 때 시도해주세요.(프리마켓 ~ 애프터마켓의 영업일인 평일)", color=discord.Color.red()))
         return
-    
-    if price <= 0 or len(str(price).split('.')[-1]) > 2:
-        await ctx.reply(embed=discord.Embed(description="가격은 0보다 커야 하며 소수점 두 자리까지 입력해야 합니다.", color=discord.Color.red()))
+
+    try:
+        legs = parse_basket(orders)
+    except ValueError as e:
+        await ctx.reply(embed=discord.Embed(description=str(e), color=discord.Color.red()))
         return
-    
+    if not legs:
+        await ctx.reply(embed=discord.Embed(description="주문할 종목을 입력해주세요. (예: `w!일괄주문 AAPL:10 MSFT:-5`)", color=discord.Color.red()))
+        return
+    if len(legs) > BASKET_MAX_LEGS:
+        await ctx.reply(embed=discord.Embed(description=f"일괄 주문은 최대 {BASKET_MAX_LEGS}종목까지 가능합니다.", color=discord.Color.red()))
+        return
+
+    # 모든 종목 시세를 한 번에 조회
+    prices = await fetch_stock_prices([symbol for symbol, _ in legs])
+    invalid = [symbol for symbol, _ in legs if not prices.get(symbol)]
+    if invalid:
+        await ctx.reply(embed=discord.Embed(description=f"**유효하지 않은 주식 기호입니다: {', '.join(invalid)}**", color=discord.Color.red()))
+        return
+
     user_id = ctx.author.id
-    c.execute("SELECT balance FROM users WHERE id=?", (user_id,))
-    result = c.fetchone()
-    if result:
-        balance = result[0]
+    priced = [(symbol, shares, prices[symbol]) for symbol, shares in legs]
+    status, detail = await storage.write(execute_basket, user_id, priced)
+    if status == 'ok':
+        embed = discord.Embed(title=f"{ctx.author.display_name}님의 일괄 주문이 체결되었습니다.", color=discord.Color.green())
+        for symbol, shares, price in priced:
+            if shares > 0:
+                embed.add_field(name=f"매수 {symbol}", value=f"{shares}주 × ${price:,.2f} = ${price * shares:,.2f}", inline=False)
+            else:
+                embed.add_field(name=f"매도 {symbol}", value=f"{-shares}주 × ${price:,.2f} = ${-price * shares:,.2f} (수수료 후 ${-price * shares * 0.999:,.2f})", inline=False)
+        embed.add_field(name="체결 후 잔고", value=f"${format_currency(detail)}", inline=False)
+        await ctx.reply(embed=embed)
+        await update_user_rank(user_id)
+    elif status == 'not_held':
+        await ctx.reply(embed=discord.Embed(description=f"**{detail} 주식을 보유하고 있지 않습니다.**", color=discord.Color.red()))
+    elif status == 'insufficient_shares':
+        symbol, held = detail
+        await ctx.reply(embed=discord.Embed(description=f"**{ctx.author.display_name}님의 {symbol} 보유 주식 수량이 부족합니다. (보유: {held}주)**", color=discord.Color.red()))
+    elif status == 'insufficient':
+        available, cost = detail
+        await ctx.reply(embed=discord.Embed(
+            description=f"""
+            **{ctx.author.display_name}님의 잔액이 부족합니다.**
+            **사용 가능 금액(매도 대금 포함): ${available:,.2f}**
+            **매수 총 금액: ${cost:,.2f}**
+            """,
+            color=discord.Color.red()
+        ))
     else:
-        await ctx.reply(embed=discord.Embed(description="사용자 정보를 찾을 수 없습니다.", color=discord.Color.red()))
-        return
-    
-    total_cost = shares * price
-    if shares <= 0 or total_cost > balance:
-        await ctx.reply(embed=discord.Embed(description="구매하려는 주식 수량이 잔고를 초과하거나 0보다 작습니다.", color=discord.Color.red()))
+        await ctx.reply(embed=discord.Embed(description=f"**{ctx.author.display_name} 등록되지 않았습니다. w!등록 명령어로 등록해주세요.**", color=discord.Color.red()))
+
+# 거래 내역 페이지당 건수, CSV 내보내기 시 한 번에 읽는 행 수
+HISTORY_PER_PAGE = 10
+HISTORY_EXPORT_CHUNK_ROWS = 5000
+# CSV를 메모리에 두는 최대 크기 (넘으면 임시 파일로 넘김)
+HISTORY_EXPORT_SPOOL_BYTES = 1024 * 1024
+TRANSACTION_COLUMNS = ('id', 'timestamp', 'type', 'stock_symbol', 'shares', 'price')
+
+def count_transactions(cur, user_id):
+    return cur.execute("SELECT COUNT(*) FROM transactions WHERE user_id=?", (user_id,)).fetchone()[0]
+
+# 최신순 키셋 페이지: before=(timestamp, id)보다 이전 거래만 조회하므로 깊은 페이지도 인덱스 탐색 한 번
+def load_transaction_page(cur, user_id, before=None, limit=HISTORY_PER_PAGE):
+    if before is None:
+        cur.execute(f"""
+        SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions WHERE user_id=?
+        ORDER BY timestamp DESC, id DESC LIMIT ?
+        """, (user_id, limit))
+    else:
+        cur.execute(f"""
+        SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions WHERE user_id=? AND (timestamp, id) < (?, ?)
+        ORDER BY timestamp DESC, id DESC LIMIT ?
+        """, (user_id, *before, limit))
+    return cur.fetchall()
+
+# 유저의 전체 거래 내역을 CSV로 파일에 기록 (행을 조금씩 읽어서 씀)
+def write_transactions_csv(cur, user_id, file):
+    text = TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    writer = csv.writer(text)
+    writer.writerow(TRANSACTION_COLUMNS)
+    cur.execute(f"SELECT {', '.join(TRANSACTION_COLUMNS)} FROM transactions WHERE user_id=? ORDER BY timestamp, id", (user_id,))
+    while True:
+        rows = cur.fetchmany(HISTORY_EXPORT_CHUNK_ROWS)
+        if not rows:
+            break
+        writer.writerows(rows)
+    text.flush()
+    text.detach()
+
+# 파일을 gzip으로 압축한 새 임시 파일 반환
+def gzip_file(file):
+    compressed = tempfile.SpooledTemporaryFile(max_size=HISTORY_EXPORT_SPOOL_BYTES)
+    file.seek(0)
+    with gzip.GzipFile(fileobj=compressed, mode='wb') as archive:
+        while chunk := file.read(1024 * 1024):
+            archive.write(chunk)
+    file.close()
+    compressed.seek(0)
+    return compressed
+
+def format_transaction(transaction_id, timestamp, transaction_type, symbol, shares, price):
+    label = "매수" if transaction_type == 'buy' else "매도"
+    return f"`#{transaction_id}` {timestamp} {label} {symbol} {shares}주 × ${price:,.2f}"
+
+# 거래 내역 명령어 (w!거래내역 csv 로 전체 내역 내보내기)
+@bot.command(name='거래내역')
+async def trade_history(ctx, export: str = None):
+    user_id = ctx.author.id
+    if export is not None:
+        if export.lower() != 'csv':
+            await ctx.reply(embed=discord.Embed(description="사용법: `w!거래내역` 또는 `w!거래내역 csv`", color=discord.Color.red()))
+            return
+        await export_trade_history(ctx)
         return
-    
-    now = datetime.now(tz=pytz.UTC).isoformat()
-    c.execute("INSERT INTO limit_orders (user_id, symbol, shares, price, order_type, timestamp) VALUES (?, ?, ?, ?, 'buy', ?)", 
-              (user_id, symbol.upper(), shares, price, now))
-    c.execute("UPDATE users SET balance = balance - ? WHERE id=?", (total_cost, user_id))
-    conn.commit()
-    await ctx.reply(embed=discord.Embed(
-        description=f"{symbol.upper()} 주식을 {shares}주, 주당 ${price:.2f}에 예약 매수했습니다. 이 예약은 24시간 동안 유효합니다.",
-        color=discord.Color.green()
-    ))
 
+    total = await storage.read(count_transactions, user_id)
+    if not total:
+        await ctx.reply(embed=discord.Embed(description="거래 내역이 없습니다.", color=discord.Color.red()))
+        return
 
+    # 페이지별 마지막 행의 (timestamp, id): 다음 페이지의 키셋 커서
+    cursors = {0: None}
+
+    async def build_page(page):
+        before = cursors.get(page)
+        if before is None and page > 0:
+            # 이전 페이지를 거치지 않은 경우에만 앞 페이지들을 이어서 조회
+            await build_page(page - 1)
+            before = cursors[page]
+        rows = await storage.read(load_transaction_page, user_id, before)
+        if rows:
+            cursors[page + 1] = (rows[-1][1], rows[-1][0])
+        return discord.Embed(
+            title=f"{ctx.author.display_name}님의 거래 내역",
+            description='\n'.join(format_transaction(*row) for row in rows) or "거래 내역이 없습니다.",
+            color=discord.Color.blue(),
+        )
 
-# 지정가 매도
-@bot.command(name='예약매도')
-async def limit_sell(ctx, symbol: str, shares: int, price: float):
-    if not is_market_open():  
+    await Paginator(math.ceil(total / HISTORY_PER_PAGE), build_page).start(ctx)
+
+async def export_trade_history(ctx):
+    file = tempfile.SpooledTemporaryFile(max_size=HISTORY_EXPORT_SPOOL_BYTES)
+    try:
+        await storage.read(write_transactions_csv, ctx.author.id, file)
+        filename = f"transactions_{ctx.author.id}.csv"
+        # 업로드 한도를 넘으면 gzip으로 압축
+        limit = ctx.guild.filesize_limit if ctx.guild is not None else 8 * 1024 * 1024
+        if file.tell() > limit:
+            file = await run_io(gzip_file, file)
+            filename += '.gz'
+        file.seek(0)
+        await ctx.reply(content=f"{ctx.author.display_name}님의 전체 거래 내역입니다.", file=discord.File(file, filename=filename))
+    finally:
+        file.close()
+
+# 예약 주문 유효 시간
+LIMIT_ORDER_TTL = timedelta(hours=24)
+
+# 예약 주문 한 건
+class LimitOrder:
+    __slots__ = ('order_id', 'user_id', 'symbol', 'shares', 'price', 'order_type', 'created_at', 'expires_at')
+
+    def __init__(self, order_id, user_id, symbol, shares, price, order_type, created_at):
+        self.order_id = order_id
+        self.user_id = user_id
+        self.symbol = symbol
+        self.shares = shares
+        self.price = price
+        self.order_type = order_type
+        self.created_at = created_at
+        self.expires_at = created_at + LIMIT_ORDER_TTL
+
+    @classmethod
+    def from_row(cls, row):
+        order_id, user_id, symbol, shares, price, order_type, timestamp = row
+        created_at = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        if created_at.tzinfo is None:
+            created_at = created_at.replace(tzinfo=pytz.UTC)
+        return cls(order_id, user_id, symbol, shares, price, order_type, created_at)
+
+# 심볼별 호가창: 매수는 최대 힙, 매도는 최소 힙 (취소된 주문은 꺼낼 때 건너뜀)
+class OrderBook:
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self.bids = []  # (-price, created_at, order_id)
+        self.asks = []  # (price, created_at, order_id)
+        self.live = 0
+
+    def add(self, order):
+        if order.order_type == 'buy':
+            heapq.heappush(self.bids, (-order.price, order.created_at, order.order_id))
+        else:
+            heapq.heappush(self.asks, (order.price, order.created_at, order.order_id))
+        self.live += 1
+
+    def pop_crossed(self, price, orders):
+        # 현재가 이상으로 사려는 매수 주문과 현재가 이하로 팔려는 매도 주문만 꺼냄
+        crossed = []
+        while self.bids and (-self.bids[0][0] >= price or self.bids[0][2] not in orders):
+            order = orders.get(heapq.heappop(self.bids)[2])
+            if order is not None:
+                crossed.append(order)
+        while self.asks and (self.asks[0][0] <= price or self.asks[0][2] not in orders):
+            order = orders.get(heapq.heappop(self.asks)[2])
+            if order is not None:
+                crossed.append(order)
+        self.live -= len(crossed)
+        return crossed
+
+    def compact(self, orders):
+        # 취소/만료된 항목이 많이 쌓이면 힙을 다시 만듦
+        if len(self.bids) + len(self.asks) > 2 * self.live + 64:
+            self.bids = [entry for entry in self.bids if entry[2] in orders]
+            self.asks = [entry for entry in self.asks if entry[2] in orders]
+            heapq.heapify(self.bids)
+            heapq.heapify(self.asks)
+
+# 예약 주문 매칭 엔진 (limit_orders 테이블을 메모리에 올려두고 변경 시 함께 기록)
+# 취소/만료/체결할 주문은 먼저 엔진에서 꺼내 중복 처리를 막고, DB 삭제가 커밋되면 settle, 실패하면 restore
+class MatchingEngine:
+    def __init__(self):
+        self.orders = {}  # order_id -> LimitOrder
+        self.books = {}  # symbol -> OrderBook
+        self.expiry = []  # (expires_at, order_id)
+        self.reserved = {}  # user_id -> 열린 매수 주문으로 잔고에서 미리 차감한 금액 합계
+
+    def load(self, rows):
+        self.orders.clear()
+        self.books.clear()
+        self.expiry = []
+        self.reserved = {}
+        for row in rows:
+            self.add(LimitOrder.from_row(row))
+
+    def _reserve(self, order, sign):
+        if order.order_type != 'buy':
+            return
+        amount = self.reserved.get(order.user_id, 0.0) + sign * order.shares * order.price
+        if amount > 1e-9:
+            self.reserved[order.user_id] = amount
+        else:
+            self.reserved.pop(order.user_id, None)
+
+    def add(self, order):
+        self._reserve(order, 1)
+        self._insert(order)
+
+    def restore(self, orders):
+        # 꺼낸 주문을 DB에 반영하지 못했을 때 다시 넣음 (예약 금액은 settle 전까지 그대로 유지됨)
+        for order in orders:
+            self._insert(order)
+
+    def settle(self, order):
+        # 꺼낸 주문이 DB에서 삭제된 뒤(커밋 후) 예약 금액을 풂
+        self._reserve(order, -1)
+
+    def _insert(self, order):
+        self.orders[order.order_id] = order
+        book = self.books.get(order.symbol)
+        if book is None:
+            book = self.books[order.symbol] = OrderBook(order.symbol)
+        book.add(order)
+        heapq.heappush(self.expiry, (order.expires_at, order.order_id))
+
+    def _discard(self, order):
+        book = self.books[order.symbol]
+        book.live -= 1
+        if book.live == 0:
+            del self.books[order.symbol]
+        else:
+            book.compact(self.orders)
+
+    def cancel(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            self._discard(order)
+        return order
+
+    def pop_expired(self, now):
+        expired = []
+        while self.expiry and self.expiry[0][0] <= now:
+            order = self.orders.pop(heapq.heappop(self.expiry)[1], None)
+            if order is not None:
+                self._discard(order)
+                expired.append(order)
+        return expired
+
+    def symbols(self):
+        return set(self.books)
+
+    def match(self, symbol, price):
+        book = self.books.get(symbol)
+        if book is None:
+            return []
+        crossed = book.pop_crossed(price, self.orders)
+        for order in crossed:
+            del self.orders[order.order_id]
+        if book.live == 0:
+            del self.books[symbol]
+        return crossed
+
+    def user_orders(self, user_id):
+        return sorted((order for order in self.orders.values() if order.user_id == user_id), key=lambda order: order.order_id)
+
+matching_engine = MatchingEngine()
+
+def load_limit_orders(cur):
+    cur.execute("SELECT order_id, user_id, symbol, shares, price, order_type, timestamp FROM limit_orders")
+    return cur.fetchall()
+
+# 예약 주문 저장 (매수는 잔고를 미리 차감), 잔고가 부족하면 None
+def insert_limit_order(cur, user_id, symbol, shares, price, order_type, timestamp):
+    if order_type == 'buy':
+        cur.execute("UPDATE users SET balance = balance - ? WHERE id=? AND balance >= ?", (shares * price, user_id, shares * price))
+        if cur.rowcount == 0:
+            return None
+        sync_portfolio(cur, user_id)
+    cur.execute("INSERT INTO limit_orders (user_id, symbol, shares, price, order_type, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, symbol, shares, price, order_type, timestamp))
+    return cur.lastrowid
+
+# 예약 주문 삭제 (매수는 차감해둔 잔고 환불, 커밋되면 엔진의 예약 금액을 풂)
+def remove_limit_orders(cur, orders):
+    for order in orders:
+        cur.execute("DELETE FROM limit_orders WHERE order_id=?", (order.order_id,))
+        if cur.rowcount == 0:
+            continue
+        if order.order_type == 'buy':
+            cur.execute("UPDATE users SET balance = balance + ? WHERE id=?", (order.shares * order.price, order.user_id))
+            sync_portfolio(cur, order.user_id)
+        storage.on_commit(matching_engine.settle, order)
+
+# 체결된 예약 주문을 한 트랜잭션으로 반영, (주문, execute_buy/execute_sell 상태) 목록 반환
+def fill_limit_orders(cur, fills):
+    results = []
+    for order, price in fills:
+        if order.order_type == 'buy':
+            # 예약 가격으로 차감해둔 금액을 돌려준 뒤 체결 가격으로 매수
+            cur.execute("UPDATE users SET balance = balance + ? WHERE id=?", (order.shares * order.price, order.user_id))
+            status, _ = execute_buy(cur, order.user_id, order.symbol, order.shares, price)
+            if status != 'ok':
+                sync_portfolio(cur, order.user_id)
+        else:
+            status, _ = execute_sell(cur, order.user_id, order.symbol, order.shares, price)
+        cur.execute("DELETE FROM limit_orders WHERE order_id=?", (order.order_id,))
+        storage.on_commit(matching_engine.settle, order)
+        results.append((order, status))
+    return results
+
+# 디스코드 API로 유저 조회
+@timed('discord', 'fetch_user')
+async def fetch_user(user_id):
+    return await bot.fetch_user(user_id)
+
+# 표시 이름 캐시 크기와 유지 시간(초), 동시에 보낼 유저 조회 요청 수
+DISPLAY_NAME_CACHE_SIZE = 4096
+DISPLAY_NAME_TTL_SECONDS = 600
+DISPLAY_NAME_FETCH_CONCURRENCY = 4
+
+# 유저 표시 이름 조회: 게이트웨이 멤버/유저 캐시 -> TTL LRU 캐시 -> API 조회(동시 요청 수 제한) 순서
+class DisplayNameResolver:
+    def __init__(self, max_size=DISPLAY_NAME_CACHE_SIZE, ttl=DISPLAY_NAME_TTL_SECONDS, concurrency=DISPLAY_NAME_FETCH_CONCURRENCY):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (표시 이름, 만료 시각)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.flight = SingleFlight('user')
+
+    def remember(self, user):
+        self._entries[user.id] = (user.display_name, _time.monotonic() + self.ttl)
+        self._entries.move_to_end(user.id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def cached(self, user_id, guild=None):
+        member = guild.get_member(user_id) if guild is not None else None
+        user = member or bot.get_user(user_id)
+        if user is not None:
+            return user.display_name
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        name, expires_at = entry
+        if expires_at <= _time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return name
+
+    async def _fetch(self, user_id):
+        async with self._semaphore:
+            try:
+                user = await fetch_user(user_id)
+            except discord.HTTPException:
+                return None
+        self.remember(user)
+        return user.display_name
+
+    async def resolve_many(self, user_ids, guild=None):
+        # {user_id: 표시 이름}, 조회할 수 없는 유저는 "알 수 없는 유저"로 표시
+        names = {user_id: self.cached(user_id, guild) for user_id in user_ids}
+        missing = [user_id for user_id, name in names.items() if name is None]
+        if missing:
+            fetched = await asyncio.gather(*(self.flight.do(user_id, partial(self._fetch, user_id)) for user_id in missing))
+            names.update(zip(missing, fetched))
+        return {user_id: name or f"알 수 없는 유저 ({user_id})" for user_id, name in names.items()}
+
+    async def resolve(self, user_id, guild=None):
+        return (await self.resolve_many([user_id], guild))[user_id]
+
+display_names = DisplayNameResolver()
+
+# 유저에게 DM 보내기 (DM이 막혀 있으면 무시)
+async def notify_user(user_id, message):
+    try:
+        user = bot.get_user(user_id) or await fetch_user(user_id)
+        await user.send(message)
+    except discord.HTTPException:
+        pass
+
+# 예약 가격 형식 확인 (0보다 크고 소수점 두 자리까지)
+def is_valid_limit_price(price):
+    return price > 0 and round(price, 2) == price
+
+async def place_limit_order(ctx, symbol, shares, price, order_type):
+    if not is_market_open():
         await ctx.reply(embed=discord.Embed(description="시장 시간이 아닙니다. 시장이 열렸을 때 시도해주세요.(프리마켓 ~ 애프터마켓의 영업일인 평일)", color=discord.Color.red()))
         return
-    
-    if price <= 0 or len(str(price).split('.')[-1]) > 2:
+
+    if not is_valid_limit_price(price):
         await ctx.reply(embed=discord.Embed(description="가격은 0보다 커야 하며 소수점 두 자리까지 입력해야 합니다.", color=discord.Color.red()))
         return
-    
+
+    symbol = symbol.upper()
     user_id = ctx.author.id
-    c.execute("SELECT COALESCE(SUM(shares), 0) FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol.upper()))
-    result = c.fetchone()
-    current_shares = result[0] if result else 0
-    
-    if shares <= 0 or shares > current_shares:
-        await ctx.reply(embed=discord.Embed(description="판매하려는 주식 수량이 보유한 수량을 초과하거나 0보다 작습니다.", color=discord.Color.red()))
+    if order_type == 'buy':
+        result = await get_user_account(user_id)
+        if not result:
+            await ctx.reply(embed=discord.Embed(description="사용자 정보를 찾을 수 없습니다.", color=discord.Color.red()))
+            return
+        if shares <= 0 or shares * price > result[0]:
+            await ctx.reply(embed=discord.Embed(description="구매하려는 주식 수량이 잔고를 초과하거나 0보다 작습니다.", color=discord.Color.red()))
+            return
+    else:
+        current_shares = next((held for held_symbol, held, _ in await get_user_holdings(user_id) if held_symbol == symbol), 0)
+        if shares <= 0 or shares > current_shares:
+            await ctx.reply(embed=discord.Embed(description="판매하려는 주식 수량이 보유한 수량을 초과하거나 0보다 작습니다.", color=discord.Color.red()))
+            return
+
+    created_at = datetime.now(tz=pytz.UTC)
+    order_id = await storage.write(insert_limit_order, user_id, symbol, shares, price, order_type, created_at.isoformat())
+    if order_id is None:
+        await ctx.reply(embed=discord.Embed(description="구매하려는 주식 수량이 잔고를 초과하거나 0보다 작습니다.", color=discord.Color.red()))
         return
-    
-    now = datetime.now(tz=pytz.UTC).isoformat()
-    c.execute("INSERT INTO limit_orders (user_id, symbol, shares, price, order_type, timestamp) VALUES (?, ?, ?, ?, 'sell', ?)", 
-              (user_id, symbol.upper(), shares, price, now))
-    conn.commit()
+    matching_engine.add(LimitOrder(order_id, user_id, symbol, shares, price, order_type, created_at))
+
+    action = "예약 매수" if order_type == 'buy' else "예약 매도"
     await ctx.reply(embed=discord.Embed(
-        description=f"{symbol.upper()} 주식을 {shares}주, 주당 ${price:.2f}에 예약 매도했습니다. 이 예약은 24시간 동안 유효합니다.",
+        description=f"{symbol} 주식을 {shares}주, 주당 ${price:.2f}에 {action}했습니다. 이 예약은 24시간 동안 유효합니다.",
         color=discord.Color.green()
     ))
 
+# 지정가 매수
+@bot.command(name='예약매수')
+async def limit_buy(ctx, symbol: str, shares: int, price: float):
+    await place_limit_order(ctx, symbol, shares, price, 'buy')
+
+# 지정가 매도
+@bot.command(name='예약매도')
+async def limit_sell(ctx, symbol: str, shares: int, price: float):
+    await place_limit_order(ctx, symbol, shares, price, 'sell')
+
 # 예약 확인
 @bot.command(name='예약확인')
 async def check_orders(ctx):
-    user_id = ctx.author.id
     now = datetime.now(tz=pytz.UTC)
-    c.execute("SELECT order_id, symbol, shares, price, order_type, timestamp FROM limit_orders WHERE user_id=?", (user_id,))
-    orders = c.fetchall()
+    orders = [order for order in matching_engine.user_orders(ctx.author.id) if order.expires_at > now]
     if orders:
         embed = discord.Embed(title=f"{ctx.author.display_name}님의 예약 주문", color=discord.Color.blue())
-        for order_id, symbol, shares, price, order_type, timestamp in orders:
-            order_time = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-            if (now - order_time) > timedelta(hours=24):
-                c.execute("DELETE FROM limit_orders WHERE order_id=?", (order_id,))
-                continue
-            time_left = timedelta(hours=24) - (now - order_time)
-            embed.add_field(name=f"주문 ID: {order_id}", value=f"종류: {order_type}, 종목: {symbol}, 수량: {shares}, 가격: ${price:.2f}, 남은 시간: {time_left}", inline=False)
-        conn.commit()
+        for order in orders:
+            time_left = order.expires_at - now
+            embed.add_field(name=f"주문 ID: {order.order_id}", value=f"종류: {order.order_type}, 종목: {order.symbol}, 수량: {order.shares}, 가격: ${order.price:.2f}, 남은 시간: {time_left}", inline=False)
         await ctx.reply(embed=embed)
     else:
         await ctx.reply(embed=discord.Embed(description=f"예약된 주문이 없습니다.", color=discord.Color.red()))
@@ -491,87 +2243,93 @@ async def check_orders(ctx):
 # 예약 취소
 @bot.command(name='예약취소')
 async def cancel_order(ctx, order_id: int):
-    user_id = ctx.author.id
-    c.execute("SELECT user_id, symbol, shares, price, order_type FROM limit_orders WHERE order_id=? AND user_id=?", (order_id, user_id))
-    result = c.fetchone()
-    if result:
-        _, symbol, shares, price, order_type = result
-        if order_type == 'buy':
-            total_cost = shares * price
-            c.execute("UPDATE users SET balance = balance + ? WHERE id=?", (total_cost, user_id))
-        c.execute("DELETE FROM limit_orders WHERE order_id=?", (order_id,))
-        conn.commit()
+    order = matching_engine.orders.get(order_id)
+    if order and order.user_id == ctx.author.id:
+        matching_engine.cancel(order_id)
+        try:
+            await storage.write(remove_limit_orders, [order])
+        except Exception:
+            matching_engine.restore([order])
+            raise
         await ctx.reply(embed=discord.Embed(description=f"주문 ID {order_id}(이)가 성공적으로 취소되었습니다.", color=discord.Color.green()))
+        await update_user_rank(ctx.author.id)
     else:
         await ctx.reply(embed=discord.Embed(description=f"유효하지 않은 주문 ID입니다.", color=discord.Color.red()))
 
+# 예약 주문 처리
+# 만료된 주문을 정리하고, 주문이 걸린 심볼마다 시세를 한 번만 조회해 가격을 넘은 주문만 체결
+async def match_limit_orders():
+    now = datetime.now(tz=pytz.UTC)
+    expired = matching_engine.pop_expired(now)
+    if expired:
+        try:
+            await storage.write(remove_limit_orders, expired)
+        except Exception:
+            matching_engine.restore(expired)
+            raise
+        for order in expired:
+            await notify_user(order.user_id, f"주문 ID {order.order_id}가 만료되었습니다.")
+        for user_id in {order.user_id for order in expired if order.order_type == 'buy'}:
+            await update_user_rank(user_id)
+
+    symbols = matching_engine.symbols()
+    if not symbols or not is_market_open(now):
+        return
+
+    prices = await fetch_stock_prices(symbols)
+    fills = [(order, price) for symbol, price in prices.items() for order in matching_engine.match(symbol, price)]
+    if not fills:
+        return
+
+    try:
+        results = await storage.write(fill_limit_orders, fills)
+    except Exception:
+        matching_engine.restore([order for order, _ in fills])
+        raise
+    for order, status in results:
+        if status != 'ok':
+            if order.order_type == 'sell':
+                reason = "보유 주식 부족"
+            elif status == 'unregistered':
+                reason = "등록되지 않은 사용자"
+            else:
+                reason = "잔고 부족"
+            await notify_user(order.user_id, f"주문 ID {order.order_id}가 {reason}으로 취소되었습니다.")
+            await update_user_rank(order.user_id)
+            continue
+        price = prices[order.symbol]
+        action = "구매" if order.order_type == 'buy' else "판매"
+        await notify_user(order.user_id, f"주문 ID {order.order_id}가 성사되었습니다. {order.shares}주를 주당 ${price:.2f}에 {action}했습니다.")
+        await update_user_rank(order.user_id)
+
 # 예약 주문 처리 태스크
 @tasks.loop(minutes=1)
 async def process_limit_orders():
-    now = datetime.now(tz=pytz.UTC)
-    c.execute("SELECT order_id, user_id, symbol, shares, price, order_type, timestamp FROM limit_orders")
-    orders = c.fetchall()
-    for order in orders:
-        order_id, user_id, symbol, shares, price, order_type, timestamp = order
-        order_time = datetime.fromisoformat(timestamp)
-        if (now - order_time) > timedelta(hours=24):
-            if order_type == 'buy':
-                total_cost = shares * price
-                c.execute("UPDATE users SET balance = balance + ? WHERE id=?", (total_cost, user_id))
-            c.execute("DELETE FROM limit_orders WHERE order_id=?", (order_id,))
-            await bot.fetch_user(user_id).send(f"주문 ID {order_id}가 만료되었습니다.")
-            continue
+    try:
+        await match_limit_orders()
+    except Exception as e:
+        print(f"예약 주문 처리 중 오류: {e}")
 
-        current_price = get_stock_price(symbol)
-        if (order_type == 'buy' and current_price <= price) or (order_type == 'sell' and current_price >= price):
-            if order_type == 'buy':
-                c.execute("SELECT balance FROM users WHERE id=?", (user_id,))
-                balance = c.fetchone()[0]
-                total_cost = shares * current_price
-                if balance >= total_cost:
-                    c.execute("UPDATE users SET balance = balance - ? WHERE id=?", (total_cost, user_id))
-                    c.execute("SELECT shares, average_price FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol))
-                    result = c.fetchone()
-                    if result:
-                        current_shares, current_avg_price = result
-                        new_shares = current_shares + shares
-                        new_avg_price = ((current_shares * current_avg_price) + (shares * current_price)) / new_shares
-                        c.execute("UPDATE stocks SET shares = ?, average_price = ? WHERE user_id=? AND stock_symbol=?", 
-                                  (new_shares, new_avg_price, user_id, symbol))
-                    else:
-                        c.execute("INSERT INTO stocks (user_id, stock_symbol, shares, average_price) VALUES (?, ?, ?, ?)", 
-                                  (user_id, symbol, shares, current_price))
-                    record_transaction(user_id, symbol, shares, current_price, 'buy')
-                    await bot.fetch_user(user_id).send(f"주문 ID {order_id}가 성사되었습니다. {shares}주를 주당 ${current_price:.2f}에 구매했습니다.")
-            
-            elif order_type == 'sell':
-                c.execute("SELECT shares, average_price FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol))
-                result = c.fetchone()
-                if result:
-                    current_shares, current_avg_price = result
-                    if shares <= current_shares:
-                        total_revenue = shares * current_price
-                        c.execute("UPDATE users SET balance = balance + ? WHERE id=?", (total_revenue, user_id))
-                        new_shares = current_shares - shares
-                        if new_shares > 0:
-                            c.execute("UPDATE stocks SET shares = ? WHERE user_id=? AND stock_symbol=?", 
-                                      (new_shares, user_id, symbol))
-                        else:
-                            c.execute("DELETE FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol))
-                        record_transaction(user_id, symbol, shares, current_price, 'sell')
-                        await bot.fetch_user(user_id).send(f"주문 ID {order_id}가 성사되었습니다. {shares}주를 주당 ${current_price:.2f}에 판매했습니다.")
-            c.execute("DELETE FROM limit_orders WHERE order_id=?", (order_id,))
-    conn.commit()'''
 
 
+# 보너스 지급 (잔고는 상대값으로 갱신해 동시에 체결된 거래를 덮어쓰지 않음)
+def grant_bonus(cur, user_id, bonus_usd, last_bonus_time, now):
+    cur.execute("""
+    UPDATE users SET balance = balance + ?, total_bonus = total_bonus + ?, last_bonus_time = ?
+    WHERE id = ? AND last_bonus_time IS ?
+    """, (bonus_usd, bonus_usd, now, user_id, last_bonus_time))
+    if cur.rowcount != 1:
+        return False
+    sync_portfolio(cur, user_id)
+    return True
+
 # 보너스 명령어
 @bot.command(name='보너스')
 async def bonus(ctx):
     user_id = ctx.author.id
-    c.execute("SELECT balance, total_bonus, last_bonus_time FROM users WHERE id=?", (user_id,))
-    result = c.fetchone()
+    result = await get_user_account(user_id)
     if result:
-        balance, total_bonus, last_bonus_time = result
+        balance, _, total_bonus, last_bonus_time = result
 
         if not check_bonus_cooldown(last_bonus_time):
             cooldown_end = datetime.fromisoformat(last_bonus_time) + timedelta(days=1)
@@ -583,81 +2341,794 @@ async def bonus(ctx):
             return
 
         bonus_usd = 100
-        total_bonus_usd = total_bonus + bonus_usd
-        new_balance_usd = balance + bonus_usd
         now = datetime.now(tz=pytz.UTC).isoformat()
 
-        c.execute("UPDATE users SET balance = ?, total_bonus = ?, last_bonus_time = ? WHERE id = ?", 
-                  (new_balance_usd, total_bonus_usd, now, user_id))
-        conn.commit()
+        # 조회 이후 다른 명령이 먼저 보너스를 받았다면 지급하지 않음
+        if not await storage.write(grant_bonus, user_id, bonus_usd, last_bonus_time, now):
+            await ctx.reply(embed=discord.Embed(
+                description=f"{ctx.author.display_name}님, 아직 보너스를 받을 수 없습니다.",
+                color=discord.Color.red()
+            ))
+            return
 
         await ctx.reply(embed=discord.Embed(
             description=f"{ctx.author.display_name}님, 24시간 쿨타임이 지난 후 ${bonus_usd:,.2f}이 지급되었습니다.",
             color=discord.Color.green()
         ))
+        await update_user_rank(user_id)
     else:
         await ctx.reply(embed=discord.Embed(description=f"{ctx.author.display_name} 등록되지 않았습니다. w!등록 명령어로 등록해주세요.", color=discord.Color.red()))
 
 
 
-@bot.command(name='리더보드')
-async def leaderboard(ctx):
-    c.execute("SELECT id, balance, initial_balance, total_bonus FROM users")
-    users = c.fetchall()
+# 전체 유저의 보유 주식을 유저 × 종목 희소 행렬(COO)로 담아 한 번에 평가
+class PortfolioMatrix:
+    def __init__(self, users, holdings):
+        # users: (id, balance, initial_balance, total_bonus), holdings: (user_id, stock_symbol, shares, average_price)
+        users = sorted(users)
+        self._build(
+            np.array([row[0] for row in users], dtype=np.int64),
+            np.array([row[1] for row in users], dtype=np.float64),
+            np.array([row[2] or 0 for row in users], dtype=np.float64),
+            np.array([row[3] or 0 for row in users], dtype=np.float64),
+            np.array([row[0] for row in holdings], dtype=np.int64),
+            np.array([row[1] for row in holdings], dtype=object).astype(str),
+            np.array([row[2] for row in holdings], dtype=np.float64),
+            np.array([row[3] for row in holdings], dtype=np.float64),
+        )
 
-    leaderboard = []
+    @classmethod
+    def from_arrays(cls, user_ids, balance, initial_balance, total_bonus, holding_users, holding_symbols, shares, average_price):
+        # 유저 배열은 id 순으로 정렬되어 있어야 함
+        matrix = cls.__new__(cls)
+        matrix._build(user_ids, balance, initial_balance, total_bonus, holding_users, holding_symbols, shares, average_price)
+        return matrix
+
+    def _build(self, user_ids, balance, initial_balance, total_bonus, holding_users, holding_symbols, shares, average_price):
+        self.user_ids = user_ids
+        self.balance = balance
+        self.initial_balance = initial_balance
+        self.total_bonus = total_bonus
+        self.reserved = np.zeros(len(user_ids), dtype=np.float64)  # 예약 매수로 묶인 금액 (잔고와 함께 현금으로 평가)
+
+        self.symbols, self.cols = np.unique(holding_symbols, return_inverse=True)
+        self.rows = np.searchsorted(self.user_ids, holding_users)
+        self.shares = np.asarray(shares, dtype=np.float64)
+        self.average_price = np.asarray(average_price, dtype=np.float64)
+
+        # 보유 주식이 있지만 users에 없는 행은 제외
+        valid = (self.rows < len(self.user_ids)) & (self.user_ids[np.minimum(self.rows, max(len(self.user_ids) - 1, 0))] == holding_users) if len(holding_users) else np.zeros(0, dtype=bool)
+        self.rows, self.cols = self.rows[valid], self.cols[valid]
+        self.shares, self.average_price = self.shares[valid], self.average_price[valid]
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def set_reserved(self, reserved):
+        # reserved: user_id -> 예약 매수로 잔고에서 미리 차감한 금액
+        for user_id, amount in reserved.items():
+            i = int(np.searchsorted(self.user_ids, user_id))
+            if i < len(self.user_ids) and self.user_ids[i] == user_id:
+                self.reserved[i] = amount
+        return self
+
+    def value(self, prices):
+        # prices: symbol -> USD 가격, 시세가 없는 종목은 평가액 0으로 계산
+        price_vector = np.array([prices.get(symbol, 0.0) for symbol in self.symbols], dtype=np.float64)
+        n = len(self.user_ids)
+        stock_value = np.bincount(self.rows, weights=self.shares * price_vector[self.cols], minlength=n)
+        cost_basis = np.bincount(self.rows, weights=self.shares * self.average_price, minlength=n)
+        total_assets = self.balance + self.reserved + stock_value
+        net_investment = self.initial_balance + cost_basis
+        return total_assets, net_investment, calculate_profit_rate(total_assets, net_investment, self.total_bonus)
+
+def load_portfolio_matrix(cur):
+    users = cur.execute("SELECT id, balance, initial_balance, total_bonus FROM users").fetchall()
+    holdings = cur.execute("SELECT user_id, stock_symbol, shares, average_price FROM stocks").fetchall()
+    return PortfolioMatrix(users, holdings)
+
+def load_user_portfolio_matrix(cur, user_id):
+    users = cur.execute("SELECT id, balance, initial_balance, total_bonus FROM users WHERE id=?", (user_id,)).fetchall()
+    holdings = cur.execute("SELECT user_id, stock_symbol, shares, average_price FROM stocks WHERE user_id=?", (user_id,)).fetchall()
+    return PortfolioMatrix(users, holdings)
+
+# 종목 심볼 <-> 정수 id (포트폴리오 캐시는 심볼 대신 id를 저장)
+class SymbolTable:
+    def __init__(self):
+        self.ids = {}
+        self.symbols = []
+
+    def id(self, symbol):
+        symbol_id = self.ids.get(symbol)
+        if symbol_id is None:
+            symbol_id = self.ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        return symbol_id
+
+# 유저 한 명의 잔고와 보유 종목 (보유 종목은 종목 id/수량/평균 매수가 병렬 배열)
+class Portfolio:
+    __slots__ = ('balance', 'initial_balance', 'total_bonus', 'last_bonus_time', 'symbol_ids', 'shares', 'average_prices')
+
+    def __init__(self, balance, initial_balance, total_bonus, last_bonus_time):
+        self.balance = balance
+        self.initial_balance = initial_balance or 0
+        self.total_bonus = total_bonus or 0
+        self.last_bonus_time = last_bonus_time
+        self.symbol_ids = array('i')
+        self.shares = array('q')
+        self.average_prices = array('d')
+
+    def position(self, symbol_id):
+        # 보유 종목 배열에서의 위치, 없으면 -1
+        try:
+            return self.symbol_ids.index(symbol_id)
+        except ValueError:
+            return -1
+
+    def set_position(self, symbol_id, shares, average_price):
+        i = self.position(symbol_id)
+        if shares > 0:
+            if i < 0:
+                self.symbol_ids.append(symbol_id)
+                self.shares.append(shares)
+                self.average_prices.append(average_price)
+            else:
+                self.shares[i] = shares
+                self.average_prices[i] = average_price
+        elif i >= 0:
+            del self.symbol_ids[i], self.shares[i], self.average_prices[i]
+
+# 전체 유저의 잔고/보유 종목을 메모리에 두는 캐시
+# 시작 시 한 번 읽고, 이후에는 쓰기 작업이 커밋될 때 바뀐 행의 값을 그대로 반영(write-through)
+# 캐시가 준비되기 전에는 조회 함수들이 DB를 직접 읽음
+class PortfolioCache:
+    def __init__(self):
+        self.users = {}  # user_id -> Portfolio
+        self.symbols = SymbolTable()
+        self.ready = False
+        self._pending = None  # 로드 중에 커밋된 갱신 (로드한 스냅샷 위에 다시 적용)
+
+    async def load(self):
+        # 스냅샷은 읽기 스레드에서 만들고, 이벤트 루프에서는 교체만 함
+        self._pending = []
+        try:
+            self.users, self.symbols = await storage.read(load_portfolios)
+        except BaseException:
+            self._pending = None
+            raise
+        # 갱신은 절대값이므로 스냅샷에 이미 반영된 것을 다시 적용해도 결과가 같음
+        pending, self._pending = self._pending, None
+        for update in pending:
+            self._apply(*update)
+        self.ready = True
+
+    def apply(self, user_id, user_row, positions):
+        # Storage.on_commit 콜백: user_row는 users 행, positions는 [(심볼, 수량, 평균 매수가)] (수량 0은 보유 종목 삭제)
+        if self._pending is not None:
+            self._pending.append((user_id, user_row, positions))
+        if self.ready:
+            self._apply(user_id, user_row, positions)
+
+    def _apply(self, user_id, user_row, positions):
+        if user_row is None:
+            self.users.pop(user_id, None)
+            return
+        portfolio = self.users.get(user_id)
+        if portfolio is None:
+            portfolio = self.users[user_id] = Portfolio(*user_row)
+        else:
+            portfolio.balance, portfolio.initial_balance, portfolio.total_bonus, portfolio.last_bonus_time = user_row
+            portfolio.initial_balance = portfolio.initial_balance or 0
+            portfolio.total_bonus = portfolio.total_bonus or 0
+        for symbol, shares, average_price in positions:
+            portfolio.set_position(self.symbols.id(symbol), shares, average_price)
+
+    def get(self, user_id):
+        return self.users.get(user_id)
+
+    def holdings(self, user_id):
+        # [(심볼, 수량, 평균 매수가)]
+        portfolio = self.users.get(user_id)
+        if portfolio is None:
+            return []
+        symbols = self.symbols.symbols
+        return [(symbols[symbol_id], shares, average_price)
+                for symbol_id, shares, average_price in zip(portfolio.symbol_ids, portfolio.shares, portfolio.average_prices)]
+
+    def matrix(self, user_ids=None):
+        # 캐시에서 바로 PortfolioMatrix 생성 (user_ids가 없으면 전체 유저)
+        if user_ids is None:
+            user_ids = sorted(self.users)
+        else:
+            user_ids = sorted(user_id for user_id in user_ids if user_id in self.users)
+        portfolios = [self.users[user_id] for user_id in user_ids]
+        n = len(portfolios)
+        counts = np.fromiter((len(p.symbol_ids) for p in portfolios), dtype=np.int64, count=n)
+        symbol_ids = np.frombuffer(b''.join(p.symbol_ids.tobytes() for p in portfolios), dtype=np.int32)
+        ids = np.array(user_ids, dtype=np.int64)
+        return PortfolioMatrix.from_arrays(
+            ids,
+            np.fromiter((p.balance for p in portfolios), dtype=np.float64, count=n),
+            np.fromiter((p.initial_balance for p in portfolios), dtype=np.float64, count=n),
+            np.fromiter((p.total_bonus for p in portfolios), dtype=np.float64, count=n),
+            np.repeat(ids, counts),
+            np.array(self.symbols.symbols, dtype=str)[symbol_ids] if len(symbol_ids) else np.array([], dtype=str),
+            np.frombuffer(b''.join(p.shares.tobytes() for p in portfolios), dtype=np.int64),
+            np.frombuffer(b''.join(p.average_prices.tobytes() for p in portfolios), dtype=np.float64),
+        )
+
+portfolio_cache = PortfolioCache()
+
+# 전체 유저의 Portfolio와 종목 id 표 생성
+def load_portfolios(cur):
+    symbols = SymbolTable()
+    users = {user_id: Portfolio(*row) for user_id, *row in cur.execute("SELECT id, balance, initial_balance, total_bonus, last_bonus_time FROM users")}
+    cur.execute("SELECT user_id, stock_symbol, shares, average_price FROM stocks WHERE shares > 0 ORDER BY user_id")
+    for user_id, rows in groupby(cur, key=itemgetter(0)):
+        portfolio = users.get(user_id)
+        if portfolio is None:
+            continue
+        rows = list(rows)
+        portfolio.symbol_ids = array('i', [symbols.id(symbol) for _, symbol, _, _ in rows])
+        portfolio.shares = array('q', [shares for _, _, shares, _ in rows])
+        portfolio.average_prices = array('d', [average_price for _, _, _, average_price in rows])
+    return users, symbols
+
+# 쓰기 작업 안에서 호출: 바뀐 유저 행(과 종목)을 다시 읽어 커밋 후 캐시에 반영하도록 예약
+def sync_portfolio(cur, user_id, symbol=None):
+    user_row = cur.execute("SELECT balance, initial_balance, total_bonus, last_bonus_time FROM users WHERE id=?", (user_id,)).fetchone()
+    positions = []
+    if symbol is not None:
+        row = cur.execute("SELECT shares, average_price FROM stocks WHERE user_id=? AND stock_symbol=?", (user_id, symbol)).fetchone()
+        positions.append((symbol, *(row or (0, 0.0))))
+    storage.on_commit(portfolio_cache.apply, user_id, user_row, positions)
+
+# 유저 계정 조회: (잔고, 초기 잔고, 보너스 합계, 마지막 보너스 시각), 없으면 None
+async def get_user_account(user_id):
+    if portfolio_cache.ready:
+        portfolio = portfolio_cache.get(user_id)
+        if portfolio is None:
+            return None
+        return portfolio.balance, portfolio.initial_balance, portfolio.total_bonus, portfolio.last_bonus_time
+    return await db_fetchone("SELECT balance, initial_balance, total_bonus, last_bonus_time FROM users WHERE id=?", (user_id,))
+
+# 유저 보유 종목 조회: [(심볼, 수량, 평균 매수가)]
+async def get_user_holdings(user_id):
+    if portfolio_cache.ready:
+        return portfolio_cache.holdings(user_id)
+    return await db_fetchall("SELECT stock_symbol, shares, average_price FROM stocks WHERE user_id=?", (user_id,))
+
+# 평가용 행렬 (예약 매수로 묶인 금액은 매칭 엔진에서 가져와 현금에 포함)
+async def get_portfolio_matrix():
+    if portfolio_cache.ready:
+        matrix = portfolio_cache.matrix()
+    else:
+        matrix = await storage.read(load_portfolio_matrix)
+    return matrix.set_reserved(matching_engine.reserved)
 
-    for user in users:
-        user_id, balance, initial_balance, total_bonus = user
-        c.execute("SELECT stock_symbol, shares, average_price FROM stocks WHERE user_id=?", (user_id,))
-        stocks = c.fetchall()
+async def get_user_portfolio_matrix(user_id):
+    if portfolio_cache.ready:
+        matrix = portfolio_cache.matrix([user_id])
+    else:
+        matrix = await storage.read(load_user_portfolio_matrix, user_id)
+    reserved = matching_engine.reserved.get(user_id)
+    return matrix.set_reserved({user_id: reserved} if reserved else {})
+
+# 유저별 총 자산과 수익률 계산 후 수익률 순으로 정렬
+def rank_users(matrix, prices):
+    total_assets, _, profit_rate = matrix.value(prices)
+    order = np.argsort(-profit_rate, kind='stable')
+    totals_krw = rate_service.convert_many(total_assets[order], 'USD', 'KRW')
+    return list(zip(matrix.user_ids[order].tolist(), total_assets[order].tolist(), totals_krw.tolist(), profit_rate[order].tolist()))
+
+# 리더보드 전체 갱신 주기(분)
+LEADERBOARD_REFRESH_MINUTES = 5
+
+# 수익률 순으로 정렬된 리더보드 스냅샷
+# 정렬 키 (-수익률, user_id) 리스트를 유지해 페이지는 슬라이스, 순위는 이진 탐색으로 조회
+class LeaderboardSnapshot:
+    def __init__(self):
+        self._keys = []  # 정렬된 (-profit_rate, user_id)
+        self._entries = {}  # user_id -> (total_assets_usd, total_assets_krw, profit_rate)
+        self._valued_at = {}  # user_id -> 전체 갱신 이후 따로 다시 평가한 시각
+        self.updated_at = None
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def ready(self):
+        return self.updated_at is not None
+
+    def replace(self, ranked):
+        # ranked: rank_users 결과 (이미 수익률 순으로 정렬됨)
+        self._entries = {user_id: (total_usd, total_krw, profit_rate) for user_id, total_usd, total_krw, profit_rate in ranked}
+        self._keys = sorted((-profit_rate, user_id) for user_id, (_, _, profit_rate) in self._entries.items())
+        self._valued_at = {}
+        self.updated_at = datetime.now(tz=pytz.UTC)
+
+    def _key(self, user_id):
+        return (-self._entries[user_id][2], user_id)
+
+    def remove(self, user_id):
+        if user_id in self._entries:
+            key = self._key(user_id)
+            del self._keys[bisect_left(self._keys, key)]
+            del self._entries[user_id]
+            self._valued_at.pop(user_id, None)
+
+    def update(self, user_id, total_assets_usd, total_assets_krw, profit_rate):
+        self.remove(user_id)
+        self._entries[user_id] = (total_assets_usd, total_assets_krw, profit_rate)
+        insort(self._keys, self._key(user_id))
+        self._valued_at[user_id] = datetime.now(tz=pytz.UTC)
+
+    def rank(self, user_id):
+        # 1부터 시작하는 순위, 없으면 None
+        if user_id not in self._entries:
+            return None
+        return bisect_left(self._keys, self._key(user_id)) + 1
+
+    def entry(self, user_id):
+        return self._entries.get(user_id)
+
+    def valued_at(self, user_id):
+        # 이 유저의 평가액이 계산된 시각 (거래 후 다시 평가했으면 그 시각, 아니면 전체 갱신 시각)
+        return self._valued_at.get(user_id, self.updated_at)
+
+    def page(self, start, count):
+        # [(순위, user_id, 총 자산 USD, 총 자산 KRW, 수익률)]
+        return [(rank, user_id) + self._entries[user_id]
+                for rank, (_, user_id) in enumerate(self._keys[start:start + count], start=start + 1)]
+
+leaderboard_snapshot = LeaderboardSnapshot()
+
+# 전체 유저를 다시 평가해 스냅샷 교체
+async def rebuild_leaderboard():
+    matrix = await get_portfolio_matrix()
+
+    # 모든 보유 종목의 시세를 한 번에 조회
+    prices = await get_valuation_prices(matrix.symbols.tolist())
+
+    leaderboard_snapshot.replace(rank_users(matrix, prices))
+
+# 거래한 유저 한 명만 다시 평가해 스냅샷에 반영
+async def update_user_rank(user_id):
+    if not leaderboard_snapshot.ready:
+        return
+    matrix = await get_user_portfolio_matrix(user_id)
+    if not len(matrix):
+        leaderboard_snapshot.remove(user_id)
+        return
+    prices = await get_valuation_prices(matrix.symbols.tolist())
+    (_, total_usd, total_krw, profit_rate), = rank_users(matrix, prices)
+    leaderboard_snapshot.update(user_id, total_usd, total_krw, profit_rate)
 
-        total_stock_value_usd = 0
-        for symbol, shares, average_price in stocks:
-            current_price = get_stock_price(symbol)
-            if current_price:
-                total_stock_value_usd += current_price * shares
+@tasks.loop(minutes=LEADERBOARD_REFRESH_MINUTES)
+async def refresh_leaderboard():
+    try:
+        await rebuild_leaderboard()
+    except Exception as e:
+        print(f"리더보드 갱신 중 오류: {e}")
 
-        total_assets_usd = balance + total_stock_value_usd
-        total_assets_krw = convert_currency(total_assets_usd, 'USD', 'KRW')
+# 리더보드 페이지당 유저 수
+LEADERBOARD_PER_PAGE = 10
 
-        net_investment_usd = initial_balance + sum(average_price * shares for _, shares, average_price in stocks)
-        net_profit_usd = total_assets_usd - net_investment_usd - total_bonus
-        profit_rate = (net_profit_usd / net_investment_usd) * 100 if net_investment_usd != 0 else 0
+@bot.command(name='리더보드')
+async def leaderboard(ctx):
+    if not leaderboard_snapshot.ready:
+        await rebuild_leaderboard()
+
+    async def build_page(page):
+        embed = discord.Embed(title="리더보드", color=discord.Color.gold())
+        rows = leaderboard_snapshot.page(page * LEADERBOARD_PER_PAGE, LEADERBOARD_PER_PAGE)
+        # 페이지의 이름을 한 번에 조회 (캐시에 없는 유저만 API로 동시 조회)
+        names = await display_names.resolve_many([user_id for _, user_id, _, _, _ in rows], ctx.guild)
+        for i, user_id, total_assets_usd, total_assets_krw, profit_rate in rows:
+            embed.add_field(name=f"{i}. {names[user_id]}", value=f"총 자산: ${format_currency(total_assets_usd)} (₩{format_currency(total_assets_krw)})\n수익률: {profit_rate:.2f}%", inline=False)
+        return embed
+
+    await Paginator(math.ceil(len(leaderboard_snapshot) / LEADERBOARD_PER_PAGE), build_page).start(ctx)
+
+# 내 순위 명령어
+@bot.command(name='내순위')
+async def my_rank(ctx):
+    user_id = ctx.author.id
+    if not leaderboard_snapshot.ready:
+        await rebuild_leaderboard()
 
-        leaderboard.append((user_id, total_assets_usd, total_assets_krw, profit_rate))
+    rank = leaderboard_snapshot.rank(user_id)
+    if rank is None:
+        await ctx.reply(embed=discord.Embed(description="등록되지 않은 사용자입니다. 먼저 `w!등록` 명령어로 등록해주세요.", color=discord.Color.red()))
+        return
 
-    leaderboard.sort(key=lambda x: x[3], reverse=True)
+    total_assets_usd, total_assets_krw, profit_rate = leaderboard_snapshot.entry(user_id)
+    embed = discord.Embed(title=f"{ctx.author.display_name}님의 순위", description=f"{rank}위 / {len(leaderboard_snapshot)}명", color=discord.Color.gold())
+    embed.add_field(name="총 자산", value=f"${format_currency(total_assets_usd)} (₩{format_currency(total_assets_krw)})", inline=False)
+    embed.add_field(name="수익률", value=f"{profit_rate:.2f}%", inline=False)
+    await ctx.reply(embed=embed)
 
-    await paginate_leaderboard(ctx, leaderboard)
+# 자산 스냅샷 기록 여부를 확인하는 주기(분)
+EQUITY_SNAPSHOT_CHECK_MINUTES = 10
+# 수익률 조회 기간 (이름, 기준 스냅샷까지의 일수)
+EQUITY_RETURN_PERIODS = (('1일', 1), ('1주', 7), ('1개월', 30))
+
+# 처음 스냅샷을 만들 때: 현재 잔고/보유 주식을 시작점으로 삼고 지금까지의 거래는 반영된 것으로 처리
+def bootstrap_equity(cur):
+    cur.execute("DELETE FROM equity_positions")
+    cur.execute("INSERT INTO equity_positions (user_id, stock_symbol, shares, cost) SELECT user_id, stock_symbol, shares, shares * average_price FROM stocks")
+    reserved = dict(cur.execute("SELECT user_id, SUM(shares * price) FROM limit_orders WHERE order_type='buy' GROUP BY user_id"))
+    cost = dict(cur.execute("SELECT user_id, SUM(cost) FROM equity_positions GROUP BY user_id"))
+    accounts = {
+        user_id: [balance + reserved.get(user_id, 0), (initial_balance or 0) + cost.get(user_id, 0), total_bonus or 0]
+        for user_id, balance, initial_balance, total_bonus in cur.execute("SELECT id, balance, initial_balance, total_bonus FROM users")
+    }
+    last_transaction_id = cur.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+    return accounts, last_transaction_id
+
+# 장 마감 후 유저별 자산 스냅샷 추가 (쓰기 트랜잭션 안에서 호출)
+# 직전 스냅샷의 현금/순투자금에 그 뒤의 거래와 보너스만 더해서 계산하고, 보유 주식은 prices(symbol -> 종가)로 평가
+# 시세가 없는 종목은 매수 원가로 평가, 기록한 유저 수 반환 (이미 기록한 날짜면 0)
+def build_equity_snapshots(cur, date, prices):
+    progress = cur.execute("SELECT date, transaction_id FROM equity_progress WHERE id = 1").fetchone()
+    if progress is not None and progress[0] >= date:
+        return 0
+    if progress is None:
+        accounts, last_transaction_id = bootstrap_equity(cur)
+    else:
+        previous_date, last_transaction_id = progress
+        # accounts: user_id -> [현금, 순투자금, 누적 보너스]
+        accounts = {
+            user_id: [cash, net_invested, total_bonus]
+            for user_id, cash, net_invested, total_bonus in cur.execute(
+                "SELECT user_id, cash, net_invested, total_bonus FROM equity_snapshots WHERE date=?", (previous_date,))
+        }
+        # 보너스는 거래 내역에 남지 않으므로 누적 보너스의 차이만큼 현금에 더함, 새로 등록한 유저는 초기 잔액에서 시작
+        for user_id, initial_balance, total_bonus in cur.execute("SELECT id, initial_balance, total_bonus FROM users").fetchall():
+            account = accounts.setdefault(user_id, [initial_balance or 0, initial_balance or 0, 0])
+            account[0] += (total_bonus or 0) - account[2]
+            account[2] = total_bonus or 0
+
+        positions = {}  # (user_id, symbol) -> [수량, 매수 원가]
+        def position(user_id, symbol):
+            key = (user_id, symbol)
+            if key not in positions:
+                row = cur.execute("SELECT shares, cost FROM equity_positions WHERE user_id=? AND stock_symbol=?", key).fetchone()
+                positions[key] = list(row) if row else [0, 0.0]
+            return positions[key]
+
+        transactions = cur.execute('''
+        SELECT id, user_id, stock_symbol, shares, price, type FROM transactions WHERE id > ? ORDER BY id
+        ''', (last_transaction_id,)).fetchall()
+        for transaction_id, user_id, symbol, shares, price, transaction_type in transactions:
+            account = accounts.setdefault(user_id, [0.0, 0.0, 0.0])
+            held = position(user_id, symbol)
+            if transaction_type == 'buy':
+                account[0] -= shares * price
+                account[1] += shares * price
+                held[0] += shares
+                held[1] += shares * price
+            else:
+                # 평균 단가 기준으로 판 수량만큼의 원가를 줄임
+                removed = held[1] * shares / held[0] if held[0] else 0.0
+                account[0] += shares * price * 0.999
+                account[1] -= removed
+                held[0] -= shares
+                held[1] -= removed
+            last_transaction_id = transaction_id
+
+        cur.executemany("DELETE FROM equity_positions WHERE user_id=? AND stock_symbol=?",
+                        [key for key, (shares, _) in positions.items() if shares <= 0])
+        cur.executemany('''
+        INSERT INTO equity_positions (user_id, stock_symbol, shares, cost) VALUES (?, ?, ?, ?)
+        ON CONFLICT(user_id, stock_symbol) DO UPDATE SET shares = excluded.shares, cost = excluded.cost
+        ''', [key + (shares, cost) for key, (shares, cost) in positions.items() if shares > 0])
+
+    holdings_value = {}
+    for user_id, symbol, shares, cost in cur.execute("SELECT user_id, stock_symbol, shares, cost FROM equity_positions"):
+        price = prices.get(symbol)
+        holdings_value[user_id] = holdings_value.get(user_id, 0.0) + (shares * price if price is not None else cost)
+    cur.executemany('''
+    INSERT OR REPLACE INTO equity_snapshots (user_id, date, cash, holdings_value, net_invested, total_bonus)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ''', [(user_id, date, cash, holdings_value.get(user_id, 0.0), net_invested, total_bonus)
+          for user_id, (cash, net_invested, total_bonus) in accounts.items()])
+    cur.execute("INSERT OR REPLACE INTO equity_progress (id, date, transaction_id) VALUES (1, ?, ?)", (date, last_transaction_id))
+    return len(accounts)
+
+# 마지막 장 마감의 스냅샷이 없으면 기록 (장중에는 건너뜀)
+async def take_equity_snapshot(now=None):
+    now = now or datetime.now(tz=pytz.UTC)
+    if is_market_open(now):
+        return 0
+    last_close = previous_market_close(now)
+    if last_close is None:
+        return 0
+    date = last_close.astimezone(EASTERN).date().isoformat()
+    progress = await db_fetchone("SELECT date FROM equity_progress WHERE id = 1")
+    if progress is not None and progress[0] >= date:
+        return 0
+    with metrics.time('job', 'equity_snapshot'):
+        symbols = [row[0] for row in await db_fetchall("SELECT DISTINCT stock_symbol FROM stocks")]
+        prices = await get_valuation_prices(symbols)
+        return await storage.write(build_equity_snapshots, date, prices)
+
+@tasks.loop(minutes=EQUITY_SNAPSHOT_CHECK_MINUTES)
+async def record_equity_snapshots():
+    try:
+        await take_equity_snapshot()
+    except Exception as e:
+        print(f"자산 스냅샷 기록 중 오류: {e}")
+
+# 유저의 스냅샷을 날짜순으로 (날짜, 총 자산, 순투자금, 누적 보너스)
+def load_equity_history(cur, user_id):
+    cur.execute('''
+    SELECT date, cash + holdings_value, net_invested, total_bonus FROM equity_snapshots
+    WHERE user_id=? ORDER BY date
+    ''', (user_id,))
+    return cur.fetchall()
+
+# 기간 수익률(%): 마지막 스냅샷과 기간 이전의 가장 가까운 스냅샷을 비교 (보너스로 늘어난 금액은 제외)
+# 반환: {기간 이름: 수익률 또는 None (비교할 스냅샷이 없으면)}
+def equity_returns(dates, equity, total_bonus, periods=EQUITY_RETURN_PERIODS):
+    returns = {}
+    for name, days in periods:
+        i = int(np.searchsorted(dates, dates[-1] - np.timedelta64(days, 'D'), side='right')) - 1
+        if i < 0 or equity[i] <= 0:
+            returns[name] = None
+            continue
+        returns[name] = float((equity[-1] - equity[i] - (total_bonus[-1] - total_bonus[i])) / equity[i] * 100)
+    return returns
 
-async def paginate_leaderboard(ctx, leaderboard, page=0):
-    max_per_page = 10
-    total_pages = math.ceil(len(leaderboard) / max_per_page)
+# 수익 그래프 명령어 (시세 조회 없이 스냅샷만 사용)
+@bot.command(name='수익그래프')
+async def equity_chart(ctx):
+    user_id = ctx.author.id
+    rows = await storage.read(load_equity_history, user_id)
+    if not rows:
+        if not await get_user_account(user_id):
+            await ctx.reply(embed=discord.Embed(description="등록되지 않은 사용자입니다. 먼저 `w!등록` 명령어로 등록해주세요.", color=discord.Color.red()))
+        else:
+            await ctx.reply(embed=discord.Embed(description="아직 기록된 자산 스냅샷이 없습니다. 자산은 매일 장 마감 후 기록됩니다.", color=discord.Color.red()))
+        return
 
-    embed = discord.Embed(title="리더보드", description=f"페이지 {page + 1}/{total_pages}", color=discord.Color.gold())
-    start = page * max_per_page
-    end = start + max_per_page
-    for i, (user_id, total_assets_usd, total_assets_krw, profit_rate) in enumerate(leaderboard[start:end], start=start + 1):
-        user = await bot.fetch_user(user_id)
-        embed.add_field(name=f"{i}. {user.display_name}", value=f"총 자산: ${format_currency(total_assets_usd)} (₩{format_currency(total_assets_krw)})\n수익률: {profit_rate:.2f}%", inline=False)
+    dates, equity, net_invested, total_bonus = zip(*rows)
+    dates = np.array(dates, dtype='datetime64[D]')
+    equity = np.array(equity, dtype=np.float64)
+    principal = np.array(net_invested, dtype=np.float64) + np.array(total_bonus, dtype=np.float64)
+    total_bonus = np.array(total_bonus, dtype=np.float64)
+
+    # 같은 날짜까지의 그래프는 캐시된 이미지 재사용
+    key = (user_id, 'equity', rows[-1][0])
+    async def render():
+        with metrics.time('render', 'equity'):
+            return await run_cpu(charts.render_equity_chart, "Equity curve", dates.tolist(), equity, principal)
+    png = await chart_cache.get_or_render(key, render)
+
+    file = discord.File(BytesIO(png), filename="equity_chart.png")
+    embed = discord.Embed(
+        title=f"{ctx.author.display_name}님의 자산 추이",
+        description=f"{rows[-1][0]} 기준 총 자산: ${format_currency(equity[-1])} (₩{format_currency(rate_service.convert(equity[-1], 'USD', 'KRW'))}) ({calculate_profit_rate(equity[-1], net_invested[-1], total_bonus[-1]):.2f}%)",
+        color=discord.Color.blue()
+    )
+    for name, value in equity_returns(dates, equity, total_bonus).items():
+        embed.add_field(name=f"{name} 수익률", value="기록 없음" if value is None else f"{value:+.2f}%", inline=True)
+    embed.set_image(url="attachment://equity_chart.png")
+    await ctx.reply(embed=embed, file=file)
+
+# 백테스트 설정: 매도 수수료는 w!판매와 같은 0.1%, 시작 금액은 등록 시 초기 잔액과 같음
+BACKTEST_SELL_FEE = 0.001
+BACKTEST_CAPITAL = 1000
+BACKTEST_MAX_SYMBOLS = 10
+# 이동평균 교차 전략의 단기/장기 이동평균 기간(거래일), 적립식 매수 간격(거래일)
+BACKTEST_SMA_FAST = 20
+BACKTEST_SMA_SLOW = 60
+BACKTEST_DCA_INTERVAL = 21
+# 명령어에서 쓰는 전략 이름 -> (전략, 표시 이름)
+BACKTEST_STRATEGIES = {
+    '보유': ('hold', "매수 후 보유"), 'hold': ('hold', "매수 후 보유"),
+    '이평': ('sma', f"이동평균 교차 ({BACKTEST_SMA_FAST}/{BACKTEST_SMA_SLOW}일)"), 'sma': ('sma', f"이동평균 교차 ({BACKTEST_SMA_FAST}/{BACKTEST_SMA_SLOW}일)"),
+    '적립': ('dca', f"적립식 매수 ({BACKTEST_DCA_INTERVAL}거래일마다)"), 'dca': ('dca', f"적립식 매수 ({BACKTEST_DCA_INTERVAL}거래일마다)"),
+}
+
+# 백테스트 결과: 날짜별 평가액과 수수료를 반영해 마지막 날 전부 청산했을 때의 금액
+class BacktestResult:
+    __slots__ = ('dates', 'equity', 'final_value', 'capital', 'trades')
+
+    def __init__(self, dates, equity, final_value, capital, trades):
+        self.dates = dates
+        self.equity = equity
+        self.final_value = final_value
+        self.capital = capital
+        self.trades = trades
+
+    @property
+    def total_return(self):
+        return (self.final_value / self.capital - 1) * 100
+
+    @property
+    def annual_return(self):
+        years = (self.dates[-1] - self.dates[0]).astype(np.int64) / 365.25
+        if years <= 0 or self.final_value <= 0:
+            return None
+        return ((self.final_value / self.capital) ** (1 / years) - 1) * 100
+
+    @property
+    def max_drawdown(self):
+        return float(np.min(self.equity / np.maximum.accumulate(self.equity) - 1)) * 100
+
+# 종가 행렬(거래일 × 종목)로 전략 실행, 시작 금액은 종목마다 똑같이 나눔 (소수점 단위 주식으로 계산)
+# 매매는 신호가 난 날 종가에 체결하며 하루씩 반복하지 않고 배열 전체를 한 번에 계산
+def run_backtest(dates, closes, strategy, capital=BACKTEST_CAPITAL, fast=BACKTEST_SMA_FAST, slow=BACKTEST_SMA_SLOW, interval=BACKTEST_DCA_INTERVAL):
+    closes = np.asarray(closes, dtype=np.float64)
+    days, symbol_count = closes.shape
+    allocation = capital / symbol_count
+    keep = 1 - BACKTEST_SELL_FEE
+
+    if strategy == 'hold':
+        # 첫날 종가에 전부 매수
+        shares = allocation / closes[0]
+        equity = closes @ shares
+        final_value = float(equity[-1] * keep)
+        trades = symbol_count
+    elif strategy == 'sma':
+        # 단기 이동평균이 장기 이동평균 위에 있는 동안 보유, 아래로 내려가면 전부 매도
+        with np.errstate(invalid='ignore'):
+            position = rolling_mean(closes, fast) > rolling_mean(closes, slow)
+        held = np.vstack([np.zeros((1, symbol_count), dtype=bool), position[:-1]])
+        exits = held & ~position
+        growth = np.where(held, closes / np.vstack([closes[:1], closes[:-1]]), 1.0) * np.where(exits, keep, 1.0)
+        value = allocation * np.cumprod(growth, axis=0)
+        equity = value.sum(axis=1)
+        final_value = float(np.sum(value[-1] * np.where(position[-1], keep, 1.0)))
+        trades = int(np.count_nonzero(position & ~held) + np.count_nonzero(exits))
+    elif strategy == 'dca':
+        # interval 거래일마다 같은 금액씩 매수
+        buy_days = np.arange(days) % interval == 0
+        amount = allocation / np.count_nonzero(buy_days)
+        shares = np.cumsum(np.where(buy_days[:, None], amount / closes, 0.0), axis=0)
+        cash = capital - np.cumsum(buy_days) * amount * symbol_count
+        holdings = (shares * closes).sum(axis=1)
+        equity = cash + holdings
+        final_value = float(cash[-1] + holdings[-1] * keep)
+        trades = int(np.count_nonzero(buy_days)) * symbol_count
+    else:
+        raise ValueError(f"알 수 없는 전략: {strategy}")
+    return BacktestResult(dates, equity, final_value, capital, trades)
+
+# 로컬 일봉 히스토리로 백테스트 (모든 종목에 종가가 있는 날만 사용), 데이터가 부족하면 None
+async def backtest_symbols(symbols, strategy, start=None, end=None, capital=BACKTEST_CAPITAL):
+    symbols = [symbol.upper() for symbol in symbols]
+    await asyncio.gather(*(history_store.sync(symbol) for symbol in symbols))
+    histories = await asyncio.gather(*(history_store.arrays(symbol, start=start, end=end) for symbol in symbols))
+    dates = histories[0]['date']
+    for history in histories[1:]:
+        dates = np.intersect1d(dates, history['date'], assume_unique=True)
+    if len(dates) < 2:
+        return None
+    closes = np.column_stack([history['close'][np.searchsorted(history['date'], dates)] for history in histories])
+    return run_backtest(dates, closes, strategy, capital)
+
+# 백테스트 명령어: w!백테스트 [전략] [시작일] [심볼...]
+@bot.command(name='백테스트')
+async def backtest(ctx, strategy: str, start: str, *symbols: str):
+    if strategy.lower() not in BACKTEST_STRATEGIES:
+        await ctx.reply(embed=discord.Embed(description="전략은 `보유`, `이평`, `적립` 중 하나를 입력해주세요.", color=discord.Color.red()))
+        return
+    strategy, strategy_name = BACKTEST_STRATEGIES[strategy.lower()]
+    try:
+        start = date.fromisoformat(start).isoformat()
+    except ValueError:
+        await ctx.reply(embed=discord.Embed(description="시작일은 `YYYY-MM-DD` 형식으로 입력해주세요.", color=discord.Color.red()))
+        return
+    symbols = list(dict.fromkeys(symbol.upper() for symbol in symbols))
+    if not symbols or len(symbols) > BACKTEST_MAX_SYMBOLS:
+        await ctx.reply(embed=discord.Embed(description=f"심볼은 1개에서 {BACKTEST_MAX_SYMBOLS}개까지 입력할 수 있습니다.", color=discord.Color.red()))
+        return
 
-    view = View()
-    if page > 0:
-        prev_button = Button(label="이전", style=discord.ButtonStyle.primary)
-        async def prev_callback(interaction):
-            await paginate_leaderboard(ctx, leaderboard, page - 1)
-        prev_button.callback = prev_callback
-        view.add_item(prev_button)
+    started = _time.perf_counter()
+    result = await backtest_symbols(symbols, strategy, start=start)
+    elapsed = _time.perf_counter() - started
+    if result is None:
+        await ctx.reply(embed=discord.Embed(description="백테스트에 사용할 주식 데이터가 부족합니다.", color=discord.Color.red()))
+        return
 
-    if end < len(leaderboard):
-        next_button = Button(label="다음", style=discord.ButtonStyle.primary)
-        async def next_callback(interaction):
-            await paginate_leaderboard(ctx, leaderboard, page + 1)
-        next_button.callback = next_callback
-        view.add_item(next_button)
+    color = discord.Color.green() if result.final_value >= result.capital else discord.Color.red()
+    embed = discord.Embed(title=f"백테스트: {strategy_name}", description=f"{', '.join(symbols)} / {result.dates[0]} ~ {result.dates[-1]}", color=color)
+    embed.add_field(name="시작 금액", value=f"${format_currency(result.capital)}", inline=True)
+    embed.add_field(name="최종 금액 (청산, 수수료 0.1% 반영)", value=f"${format_currency(result.final_value)}", inline=True)
+    embed.add_field(name="총 수익률", value=f"{result.total_return:+.2f}%", inline=True)
+    annual_return = result.annual_return
+    embed.add_field(name="연환산 수익률", value="-" if annual_return is None else f"{annual_return:+.2f}%", inline=True)
+    embed.add_field(name="최대 낙폭", value=f"{result.max_drawdown:.2f}%", inline=True)
+    embed.add_field(name="매매 횟수", value=f"{result.trades}회", inline=True)
+    embed.set_footer(text=f"계산 시간 {elapsed * 1000:.0f}ms")
+    await ctx.reply(embed=embed)
 
-    await ctx.reply(embed=embed, view=view)
+# 지표를 Prometheus 텍스트 형식으로 변환
+def prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_prometheus():
+    histograms, errors = metrics.snapshot()
+    lines = []
+    for name in sorted({name for name, _ in histograms}):
+        label_key = 'command' if name == 'command' else 'op'
+        metric = f"mock_invest_{name}_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for (histogram_name, label), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            label = prometheus_label(label)
+            cumulative = 0
+            for bound, bucket_count in zip(METRIC_BUCKETS, histogram.counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{metric}_bucket{{{label_key}="{label}",le="{le}"}} {cumulative}')
+            lines.append(f'{metric}_sum{{{label_key}="{label}"}} {histogram.total}')
+            lines.append(f'{metric}_count{{{label_key}="{label}"}} {histogram.count}')
+    if errors:
+        lines.append("# TYPE mock_invest_errors_total counter")
+        for (name, label), count in sorted(errors.items()):
+            lines.append(f'mock_invest_errors_total{{metric="{name}",op="{prometheus_label(label)}"}} {count}')
+    # 지표 묶음(family)마다 TYPE 줄 바로 뒤에 그 묶음의 값만 이어서 씀
+    lines.append("# TYPE mock_invest_admission_queue_depth gauge")
+    for name, depth in admission.queue_depths().items():
+        lines.append(f'mock_invest_admission_queue_depth{{class="{name}"}} {depth}')
+    lines.append("# TYPE mock_invest_admission_running gauge")
+    for name, running in admission.running.items():
+        lines.append(f'mock_invest_admission_running{{class="{name}"}} {running}')
+    lines.append("# TYPE mock_invest_admission_dropped_total counter")
+    lines.append(f"mock_invest_admission_dropped_total {admission.dropped}")
+    flights = (price_flight, history_flight, chart_cache.flight, display_names.flight)
+    lines.append("# TYPE mock_invest_singleflight_calls_total counter")
+    for flight in flights:
+        lines.append(f'mock_invest_singleflight_calls_total{{flight="{flight.name}"}} {flight.calls}')
+    lines.append("# TYPE mock_invest_singleflight_coalesced_total counter")
+    for flight in flights:
+        lines.append(f'mock_invest_singleflight_coalesced_total{{flight="{flight.name}"}} {flight.coalesced}')
+    return '\n'.join(lines) + '\n'
+
+# 임시 파일에 쓴 뒤 교체해서 수집기가 반쯤 쓰인 파일을 읽지 않도록 함
+def write_metrics_file(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+@tasks.loop(seconds=METRICS_EXPORT_SECONDS)
+async def export_metrics():
+    try:
+        await run_io(write_metrics_file, METRICS_PATH, render_prometheus())
+    except Exception as e:
+        print(f"지표 기록 중 오류: {e}")
+
+# 통계 명령어 (봇 소유자 또는 서버 관리자만)
+@bot.command(name='통계')
+@commands.check_any(commands.is_owner(), commands.has_permissions(administrator=True))
+async def stats(ctx):
+    histograms, errors = metrics.snapshot()
+    embed = discord.Embed(title="봇 통계", color=discord.Color.blue())
+    for name in sorted({name for name, _ in histograms}):
+        lines = []
+        for (histogram_name, label), histogram in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            error_count = errors.get((name, label), 0)
+            lines.append(f"{label}: {histogram.count}회, 평균 {histogram.total / histogram.count * 1000:.1f}ms, p50 ≤{histogram.quantile(0.5) * 1000:g}ms, p99 ≤{histogram.quantile(0.99) * 1000:g}ms" + (f", 실패 {error_count}회" if error_count else ""))
+        embed.add_field(name=name, value='\n'.join(lines)[:1024], inline=False)
+    embed.add_field(
+        name="실행 대기열",
+        value='\n'.join(f"{name}: 실행 중 {admission.running[name]}/{admission.limits[name]}, 대기 {depth}" for name, depth in admission.queue_depths().items())
+        + f"\n중복 요청 무시: {admission.dropped}회",
+        inline=False,
+    )
+    embed.add_field(
+        name="single-flight",
+        value='\n'.join(f"{flight.name}: 실행 {flight.calls}회, 합쳐짐 {flight.coalesced}회" for flight in (price_flight, history_flight, chart_cache.flight, display_names.flight)),
+        inline=False,
+    )
+    await ctx.reply(embed=embed)
 
 @bot.command(name='도움말')
 async def help(ctx):
@@ -668,45 +3139,195 @@ w!자산 - 현재 잔액과 보유 주식을 확인합니다.
 w!주식 [심볼] - 주식의 현재 가격과 그래프를 보여줍니다.
 w!구매 [심볼] [주식수] - 주식을 구매합니다. (시장가)
 w!판매 [심볼] [주식수] - 주식을 판매합니다. (시장가)
+w!일괄주문 [심볼:수량] ... - 여러 종목을 한 번에 주문합니다. (예: AAPL:10 MSFT:-5, 음수는 판매)
+w!거래내역 [csv] - 거래 내역을 확인합니다. csv를 붙이면 전체 내역을 파일로 받습니다.
 w!보너스 - 24시간마다 보너스를 받습니다.
-- 현재 개발중인 메뉴로 오류가 심각하여 잠깐 비활성화되었습니다.
-~~w!예약매수 [심볼] [주식수] [가격] - 지정가 매수 주문을 예약합니다.~~
-~~w!예약매도 [심볼] [주식수] [가격] - 지정가 매도 주문을 예약합니다.~~
-~~- 예약 매수/매도시 참고 : [가격]은 소숫점 2자리까지의 미화(달러)만 받습니다.~~ 
-~~w!예약확인 - 예약된 주문을 확인합니다. (ID를 여기서 확인 가능)~~
-~~w!예약취소 [주문ID] - 예약된 주문을 취소합니다.~~
+w!예약매수 [심볼] [주식수] [가격] - 지정가 매수 주문을 예약합니다.
+w!예약매도 [심볼] [주식수] [가격] - 지정가 매도 주문을 예약합니다.
+- 예약 매수/매도시 참고 : [가격]은 소숫점 2자리까지의 미화(달러)만 받습니다.
+w!예약확인 - 예약된 주문을 확인합니다. (ID를 여기서 확인 가능)
+w!예약취소 [주문ID] - 예약된 주문을 취소합니다.
 w!리더보드 - 수익률 리더보드를 확인합니다.
+w!내순위 - 리더보드에서 내 순위를 확인합니다.
+w!수익그래프 - 장 마감마다 기록된 총 자산 추이와 1일/1주/1개월 수익률을 확인합니다.
+w!백테스트 [전략] [시작일] [심볼...] - 시작일부터 전략대로 $1000을 운용했을 때의 결과를 계산합니다. (전략: 보유, 이평, 적립 / 예: w!백테스트 보유 2020-01-02 AAPL MSFT)
+w!통계 - (관리자) 명령어 처리 시간과 외부 호출 통계를 확인합니다.
 """
     await ctx.reply(embed=discord.Embed(description=help_text, color=discord.Color.blue()))
 
+# 시세/환율 라이브러리를 미리 불러옴 (첫 명령어에서 import 비용이 들지 않도록)
+def warm_imports():
+    import yfinance
+    import currency_converter
+
+# 첫 명령어 처리를 마친 시각 (프로세스 시작 기준, 초)
+first_command_seconds = None
+
+# 명령어 분류: 매매(trade)는 가장 먼저, 차트/순위 같은 무거운 작업(heavy)은 가장 나중에 실행
+# 목록에 없는 명령어는 조회(read)
+COMMAND_CLASSES = {
+    '등록': 'trade', '구매': 'trade', '판매': 'trade', '일괄주문': 'trade',
+    '예약매수': 'trade', '예약매도': 'trade', '예약취소': 'trade', '보너스': 'trade',
+    '주식': 'heavy', '리더보드': 'heavy', '수익그래프': 'heavy', '백테스트': 'heavy',
+}
+# 분류별 동시 실행 수, 전체 동시 실행 수, 유저 한 명의 동시 실행 수
+ADMISSION_LIMITS = {'trade': 16, 'read': 8, 'heavy': 2}
+ADMISSION_TOTAL = 20
+ADMISSION_PER_USER = 2
+
+# 같은 유저의 무거운 명령어가 이미 처리 중일 때
+class DuplicateCommand(commands.CommandError):
+    pass
+
+# 명령어 실행 허가: 분류별/전체/유저별 동시 실행 수를 넘으면 분류별 대기열에서 기다림
+# 자리가 나면 trade -> read -> heavy 순서로 대기열 앞에서부터 실행
+class AdmissionScheduler:
+    PRIORITY = ('trade', 'read', 'heavy')
+
+    def __init__(self, limits=ADMISSION_LIMITS, total=ADMISSION_TOTAL, per_user=ADMISSION_PER_USER):
+        self.limits = limits
+        self.total = total
+        self.per_user = per_user
+        self.running = {name: 0 for name in self.PRIORITY}
+        self.user_running = {}  # user_id -> 실행 중인 명령어 수
+        self.queues = {name: deque() for name in self.PRIORITY}  # (future, user_id)
+        self.heavy_keys = set()  # 대기 중이거나 실행 중인 (user_id, 명령어) (heavy만)
+        self.dropped = 0
+
+    def classify(self, command_name):
+        return COMMAND_CLASSES.get(command_name, 'read')
+
+    def _can_run(self, name, user_id):
+        return (sum(self.running.values()) < self.total
+                and self.running[name] < self.limits[name]
+                and self.user_running.get(user_id, 0) < self.per_user)
+
+    def _start(self, name, user_id):
+        self.running[name] += 1
+        self.user_running[user_id] = self.user_running.get(user_id, 0) + 1
+
+    def _queued_ahead(self, name):
+        # 같거나 높은 우선순위의 대기열에 기다리는 요청이 있으면 새 요청도 줄을 섬
+        # 유저별 동시 실행 수에만 막혀 있는 요청은 다른 유저를 막지 않도록 제외 (_dispatch도 건너뜀)
+        return any(
+            self.user_running.get(user_id, 0) < self.per_user
+            for other in self.PRIORITY[:self.PRIORITY.index(name) + 1]
+            for _, user_id in self.queues[other]
+        )
+
+    async def acquire(self, name, user_id, key=None):
+        if key is not None:
+            if key in self.heavy_keys:
+                self.dropped += 1
+                raise DuplicateCommand("이미 처리 중인 같은 요청이 있습니다. 잠시 후 다시 시도해주세요.")
+            self.heavy_keys.add(key)
+        started = _time.perf_counter()
+        if not self._queued_ahead(name) and self._can_run(name, user_id):
+            self._start(name, user_id)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            entry = (future, user_id)
+            self.queues[name].append(entry)
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release(name, user_id)
+                else:
+                    self.queues[name].remove(entry)
+                self.heavy_keys.discard(key)
+                raise
+        metrics.observe('admission_wait', name, _time.perf_counter() - started)
+
+    def release(self, name, user_id, key=None):
+        self.running[name] -= 1
+        count = self.user_running[user_id] - 1
+        if count:
+            self.user_running[user_id] = count
+        else:
+            del self.user_running[user_id]
+        if key is not None:
+            self.heavy_keys.discard(key)
+        self._dispatch()
+
+    def _dispatch(self):
+        for name in self.PRIORITY:
+            queue = self.queues[name]
+            for entry in list(queue):
+                if sum(self.running.values()) >= self.total:
+                    return
+                future, user_id = entry
+                if self.running[name] >= self.limits[name]:
+                    break
+                if self._can_run(name, user_id):
+                    queue.remove(entry)
+                    self._start(name, user_id)
+                    future.set_result(None)
+
+    def queue_depths(self):
+        return {name: len(queue) for name, queue in self.queues.items()}
+
+admission = AdmissionScheduler()
+
+# 명령어 실행 허가와 처리 시간 측정 (대기 시간도 처리 시간에 포함)
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = _time.perf_counter()
+    name = admission.classify(ctx.command.qualified_name)
+    key = (ctx.author.id, ctx.command.qualified_name) if name == 'heavy' else None
+    await admission.acquire(name, ctx.author.id, key)
+    ctx.admission = (name, ctx.author.id, key)
+
+@bot.after_invoke
+async def record_command_time(ctx):
+    if getattr(ctx, 'admission', None) is not None:
+        admission.release(*ctx.admission)
+        ctx.admission = None
+    started_at = getattr(ctx, 'started_at', None)
+    if started_at is not None:
+        metrics.observe('command', ctx.command.qualified_name, _time.perf_counter() - started_at)
+    global first_command_seconds
+    if first_command_seconds is None:
+        first_command_seconds = _time.perf_counter() - STARTED_AT
+        metrics.observe('startup', 'first_command', first_command_seconds)
+        print(f"첫 명령어 처리 완료 (시작 후 {first_command_seconds:.2f}s)")
+
 # 예외 처리
 @bot.event
 async def on_command_error(ctx, exception: Exception):  
+    metrics.error('command', ctx.command.qualified_name if ctx.command else 'unknown')
     await ctx.send(embed=discord.Embed(title="에러가 발생했습니다!", description=str(exception)))
 
 
-async def start_tasks():
-    await bot.wait_until_ready()  # 봇이 준비될 때까지 대기
-
-# 이벤트 루프 생성 및 비동기 작업 실행
-loop = asyncio.get_event_loop()
-
-# start_tasks를 이벤트 루프에서 실행
-loop.create_task(start_tasks())
-
 # 초기 설정
 @bot.event
 async def on_ready():
-    print(f'Logged in as {bot.user.name}')
-    c.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY,
-        balance REAL,
-        total_bonus REAL DEFAULT 0,
-        initial_balance REAL,
-        last_bonus_time TEXT
-    )
-    """)
-    conn.commit()
-
-bot.run('Your Bot Token')
+    ready_seconds = _time.perf_counter() - STARTED_AT
+    metrics.observe('startup', 'ready', ready_seconds)
+    print(f'Logged in as {bot.user.name} ({ready_seconds:.2f}s)')
+    await run_io(get_market_calendar)
+    if not portfolio_cache.ready:
+        await portfolio_cache.load()
+    # 리더보드 평가에 예약 매수 금액이 필요하므로 매칭 엔진을 먼저 올림
+    if not process_limit_orders.is_running():
+        matching_engine.load(await storage.read(load_limit_orders))
+        process_limit_orders.start()
+    if not refresh_currency_rates.is_running():
+        refresh_currency_rates.start()
+    if not refresh_leaderboard.is_running():
+        refresh_leaderboard.start()
+    if not poll_prices.is_running():
+        poll_prices.start()
+    if not export_metrics.is_running():
+        export_metrics.start()
+    if not record_equity_snapshots.is_running():
+        record_equity_snapshots.start()
+    # 무거운 라이브러리와 차트 워커는 로그인 후 준비 (워커를 다 띄운 뒤에 import)
+    await warm_cpu_pool()
+    await run_io(warm_imports)
+
+if __name__ == '__main__':
+    try:
+        bot.run('Your Bot Token')
+    finally:
+        shutdown_executors()
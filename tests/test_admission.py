@@ -0,0 +1,37 @@
+import asyncio
+import os
+import sys
+import tempfile
+import unittest
+
+os.environ.setdefault('MOCK_INVEST_DB', os.path.join(tempfile.mkdtemp(), 'database.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import stock
+
+
+class AdmissionSchedulerTest(unittest.IsolatedAsyncioTestCase):
+    async def test_per_user_cap_does_not_block_other_users(self):
+        admission = stock.AdmissionScheduler()
+        # 유저 1이 유저별 한도(2)를 다 쓴 상태에서 매매 명령을 하나 더 보냄
+        await admission.acquire('heavy', 1)
+        await admission.acquire('read', 1)
+        waiting = asyncio.ensure_future(admission.acquire('trade', 1))
+        await asyncio.sleep(0)
+        self.assertFalse(waiting.done())
+        self.assertEqual(admission.queue_depths()['trade'], 1)
+
+        # 다른 유저의 매매/조회는 자리가 있으므로 바로 실행
+        await asyncio.wait_for(admission.acquire('trade', 2), 1)
+        await asyncio.wait_for(admission.acquire('read', 3), 1)
+        self.assertEqual(admission.running, {'trade': 1, 'read': 2, 'heavy': 1})
+
+        # 유저 1의 명령이 끝나면 대기하던 매매 명령이 실행됨
+        admission.release('heavy', 1)
+        await asyncio.wait_for(waiting, 1)
+        self.assertEqual(admission.queue_depths()['trade'], 0)
+        self.assertEqual(admission.running['trade'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+os.environ.setdefault('MOCK_INVEST_DB', os.path.join(tempfile.mkdtemp(), 'database.db'))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import charts
+import stock
+
+
+def make_bars(count):
+    close = np.linspace(10, 20, count)
+    index = pd.date_range('2026-01-05', periods=count, freq='B')
+    return pd.DataFrame({'Open': close, 'High': close * 1.01, 'Low': close * 0.99, 'Close': close, 'Volume': np.full(count, 100)}, index=index)
+
+
+class CandleChartTest(unittest.TestCase):
+    def render(self, count):
+        bars = make_bars(count)
+        indicators = stock.compute_indicators(bars['Close'].to_numpy(dtype=np.float64))
+        png = charts.render_candle_chart('TEST', '3M', bars, indicators)
+        self.assertTrue(png.startswith(b'\x89PNG'))
+
+    def test_short_history_without_rsi(self):
+        # RSI가 전부 NaN인 15개 미만의 봉
+        self.render(10)
+
+    def test_single_bar(self):
+        self.render(1)
+
+    def test_full_history(self):
+        self.render(80)
+
+
+if __name__ == '__main__':
+    unittest.main()